@@ -10,7 +10,7 @@ Licence: GPL v3
 import os
 import sys
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import csv
 import argparse
 import contextlib
@@ -18,22 +18,84 @@ import io
 import time
 import traceback
 import re
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from utils import *
-
+import http_client
+import metrics
+import http_record
+import downloader
+from checkpoint import open_journal, JOURNAL_SUFFIX
+import incremental
+import sinks
+import rate_limiter
+
+# Used if the number of items can't be read from the site
 TOTAL_ITEMS = 18961
 DEFAULT_START_PAGE = 1
 DEFAULT_END_PAGE = 2  # 0 = all pages
 DEFAULT_ITEMS_PER_PAGE = 10
+# With --index-only, only index pages are fetched so they can be much bigger
+DEFAULT_INDEX_ITEMS_PER_PAGE = 500
 DEFAULT_SLEEP = 3
+DEFAULT_WORKERS = 1
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_SHARDS = 1
 DOWNLOAD_DIR = 'docs'
+SQLITE_TABLE = 'collection'
+MANIFEST_SQLITE_TABLE = 'manifest'
+# Rows between progress reports when fetching detail pages from a manifest
+REPORT_EVERY = 100
 HEADER=['Index', 'Title','Description','Author','Published','Status','Subject','Category',
             'Media','ISBN','Call Number','Type','Keywords','Download','URL','Error']
+# The rows of the index pages; see get_index()
+MANIFEST_HEADER = ['Index', 'Title', 'URL', 'Source', 'Call Number']
+# Only the parts of each page that are scraped are parsed
+INDEX_TARGET = ParseTarget(SoupStrainer('div', class_='weblib-item-row'), 'div.weblib-item-row')
+DETAIL_TARGET = ParseTarget(SoupStrainer(class_=re.compile('^weblib-item-')),
+                            'span.weblib-item-content-element, p.weblib-item-keyword-list')
+DOWNLOAD_TARGET = ParseTarget(SoupStrainer('a', class_='wpfb-flatbtn'), 'a.wpfb-flatbtn')
 ALLCATSGREY_COLLECTION_HOME = f'https://allcatsrgrey.org.uk/wp/find-grey-literature/?searchby=title&searchbox&weblib_orderby=barcode&weblib_order=ASC&pagenum=%s&per_page=%s'
 
 
 
-def scrape_index_data(url):
-    soup = get_page(url)
+# Phrases the site might use to report the number of search results, eg "18961 items found"
+RESULT_COUNT_PATTERNS = [
+    re.compile(r'\bof\s+([\d,]+)\s+(?:items|results|records|titles)', re.IGNORECASE),
+    re.compile(r'([\d,]+)\s+(?:items|results|records|titles)\s+(?:found|matched)', re.IGNORECASE),
+]
+PAGENUM_PATTERN = re.compile(r'[?&]pagenum=(\d+)')
+
+
+def discover_total_items(items_per_page=1):
+    """
+    Return the number of items in the collection, read from the first index page, or
+    None if it can't be found. The result count is used if the page states it; otherwise
+    the count is estimated from the last page in the pagination links.
+    """
+    soup = get_page(ALLCATSGREY_COLLECTION_HOME % (1, items_per_page))
+    if soup is None:
+        return None
+
+    text = soup.get_text(' ')
+    for pattern in RESULT_COUNT_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return int(match.group(1).replace(',', ''))
+
+    pages = [int(m.group(1)) for a in soup.find_all('a', href=True)
+             for m in [PAGENUM_PATTERN.search(a['href'])] if m]
+    if pages:
+        return max(pages) * items_per_page
+
+    return None
+
+
+@metrics.timed('scrape_index_data')
+def scrape_index_data(url, soup=None):
+    if soup is None:
+        soup = get_page(url, INDEX_TARGET)
 
     if soup == None:
         return {}
@@ -62,13 +124,27 @@ def scrape_index_data(url):
 
         yield data
 
-def scrape_page_data(url, index=1):
+@metrics.timed('scrape_page_data')
+def scrape_page_data(url, index=1, store=None):
+    """
+    Scrape the detail page for an item. If store (an incremental.PageStore) is given, the
+    page is only parsed if it has changed since it was last scraped; the returned data is
+    tagged with its incremental.STATUS.
+    """
     data = {}
     data['URL'] = url
     data['Index'] = index
 
     try:
-        soup = get_page(url)
+        if store:
+            soup, record = get_page_incremental(url, store, DETAIL_TARGET)
+            if record is not None:
+                record.update({'Index': index, incremental.STATUS: incremental.UNCHANGED})
+                print(index, ' -- Unchanged title:', record.get('Title'))
+                return record
+        else:
+            soup = get_page(url, DETAIL_TARGET)
+
         if not soup:
             raise Exception(f'Page not found: {url}')
 
@@ -102,7 +178,7 @@ def scrape_page_data(url, index=1):
                 # click on a link to get the actual document.
                 corrected_url = download_url.replace('download', 'downloads')
                 # get page describing document we want to download
-                soup2 = get_page(corrected_url)
+                soup2 = get_page(corrected_url, DOWNLOAD_TARGET)
                 # now get the url for the document to be downloaded
                 if soup2:
                     download = soup2.find('a', class_='wpfb-flatbtn')
@@ -115,37 +191,418 @@ def scrape_page_data(url, index=1):
         traceback.print_exc()
         data['Error'] = repr(traceback.format_exception(e))
 
+    if store:
+        try:
+            data[incremental.STATUS] = store.save(url, incremental.strip_status(data),
+                                                  'Error' not in data)
+        except Exception as e:
+            # keep the scraped data; the page is just parsed again next time
+            print('Warning: could not save page state for', url, e)
+            data[incremental.STATUS] = incremental.NEW
+
     if 'Title' in data:
         print(index, ' -- Retrieved title:', data['Title'])
 
     return data
 
 
-def get_all_data(csv_filename, start_page, end_page, items_per_page, sleep):
+def fetch_page_data(url, index, store=None):
+    """
+    Wrapper for scrape_page_data() for use in a worker pool: any error is recorded in the
+    Error column rather than losing the item.
+    """
+    try:
+        return scrape_page_data(url, index, store)
+    except Exception as e:
+        print('Error fetching page', url, e)
+        traceback.print_exc()
+        return {'Index': index, 'URL': url, 'Error': repr(traceback.format_exception(e))}
+
+
+def get_all_data(csv_filename, start_page, end_page, items_per_page, workers=DEFAULT_WORKERS,
+                 resume=False, store=None, delta_filename=None, progress=None, total_items=None,
+                 output_sinks=None):
+    """
+    Scrape index pages start_page to end_page (0 = the last page) and the detail pages
+    they link to. The last page is worked out from total_items, or from the first index
+    page if total_items isn't given. Scraping stops early at a short or empty index page.
+    If progress is given, it's called with (page, items, errors) after each page is saved.
+    Rows are also written to output_sinks (see sinks.py). Return a summary of the pages and items processed.
+    """
+    summary = {'pages': 0, 'items': 0, 'errors': 0}
+
+    if end_page == 0 and total_items is None:
+        total_items = collection_size()
+    calc_end_page = end_page_for(end_page, items_per_page, total_items)
+    planned_items = (calc_end_page - start_page + 1) * items_per_page
+    if total_items:
+        planned_items = min(planned_items, total_items - (start_page - 1) * items_per_page)
+    metrics.set_total(max(planned_items, 0))
+    print(f'============= Planning to scrape pages {start_page} to {calc_end_page} '
+          f'(about {max(planned_items, 0)} items)')
+    start_time = time.monotonic()
+
+    journal = open_journal(csv_filename, resume)
+    writer = OutputWriter(HEADER, csv_filename, sinks=output_sinks)
+    if store:
+        writer = incremental.IncrementalWriter(
+            writer, OutputWriter(HEADER, delta_filename, counter=metrics.DELTA_ROWS)
+            if delta_filename else None)
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    try:
+        for page in range(start_page, calc_end_page + 1):
+            # pages are numbered according to the number of items on a page
+            page_key = f'{page}/{items_per_page}'
+            if journal and journal.is_done('page', page_key):
+                print('============= Skipping completed page', page)
+                planned_items -= items_per_page
+                continue
+
+            print('============= Processing page', page)
+            url = ALLCATSGREY_COLLECTION_HOME % (page, items_per_page)
+
+            index = (page-1) * items_per_page + 1
+            soup = get_page(url, INDEX_TARGET)
+            if soup is None:
+                print('Warning: could not fetch index page', page)
+                continue
+
+            items = list(scrape_index_data(url, soup))
+            urls = [item['url'] for item in items]
+            indexes = range(index, index + len(items))
+            # Both return results in Index order as they become available, so each row is
+            # written as soon as it and the rows before it are ready.
+            if executor:
+                page_data = executor.map(fetch_page_data, urls, indexes, [store] * len(items))
+            else:
+                page_data = map(fetch_page_data, urls, indexes, [store] * len(items))
+
+            written = errors = 0
+            for data in page_data:
+                writer.write(data)
+                written += 1
+                if 'Error' in data:
+                    errors += 1
+
+            if journal:
+                journal.record('page', page_key, writer.checkpoint())
+            else:
+                writer.flush()
+
+            summary['pages'] += 1
+            summary['items'] += written
+            summary['errors'] += errors
+            if progress:
+                progress(page, written, errors)
+            print_eta(summary['items'], planned_items, start_time)
+
+            if len(items) < items_per_page:
+                print(f'============= Page {page} is the last page ({len(items)} items)')
+                break
+    finally:
+        writer.close()
+        if executor:
+            executor.shutdown()
+        if journal:
+            journal.close()
+
+    return summary
+
+
+def fetch_index_page(page, items_per_page):
+    """Return the manifest rows for index page number page, or None if it can't be fetched."""
+    url = ALLCATSGREY_COLLECTION_HOME % (page, items_per_page)
+    soup = get_page(url, INDEX_TARGET)
+    if soup is None:
+        return None
+
+    first = (page - 1) * items_per_page + 1
+    return [{'Index': index, 'Title': item['title'], 'URL': item['url'],
+             'Source': item['source'], 'Call Number': item['call_number']}
+            for index, item in enumerate(scrape_index_data(url, soup), first)]
+
+
+def get_index(csv_filename, start_page, end_page, items_per_page, workers=DEFAULT_WORKERS,
+              resume=False, total_items=None, output_sinks=None):
+    """
+    First phase of a two-phase crawl: write the rows of index pages start_page to end_page
+    (0 = the last page) to csv_filename, the manifest, without fetching the detail pages.
+    Up to workers index pages are fetched at a time and rows are written in Index order.
+    Return a summary of the pages and items processed. See get_details() for the second
+    phase.
+    """
+    summary = {'pages': 0, 'items': 0, 'errors': 0}
+
+    if end_page == 0 and total_items is None:
+        total_items = collection_size()
+    calc_end_page = end_page_for(end_page, items_per_page, total_items)
+    planned_items = (calc_end_page - start_page + 1) * items_per_page
+    if total_items:
+        planned_items = min(planned_items, total_items - (start_page - 1) * items_per_page)
+    metrics.set_total(max(planned_items, 0))
+    print(f'============= Planning to read index pages {start_page} to {calc_end_page} '
+          f'(about {max(planned_items, 0)} items)')
+    start_time = time.monotonic()
+
+    journal = open_journal(csv_filename, resume)
+    pages = [page for page in range(start_page, calc_end_page + 1)
+             if not (journal and journal.is_done('index', f'{page}/{items_per_page}'))]
+    writer = OutputWriter(MANIFEST_HEADER, csv_filename, sinks=output_sinks)
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    try:
+        for page, rows in zip(pages, executor.map(fetch_index_page, pages,
+                                                  itertools.repeat(items_per_page))):
+            if rows is None:
+                print('Warning: could not fetch index page', page)
+                summary['errors'] += 1
+                continue
+
+            print('============= Read index page', page)
+            writer.as_csv(rows)
+            if journal:
+                journal.record('index', f'{page}/{items_per_page}', writer.checkpoint())
+            else:
+                writer.flush()
+
+            summary['pages'] += 1
+            summary['items'] += len(rows)
+            print_eta(summary['items'], planned_items, start_time)
+
+            if len(rows) < items_per_page:
+                print(f'============= Page {page} is the last page ({len(rows)} items)')
+                break
+    finally:
+        writer.close()
+        executor.shutdown(cancel_futures=True)
+        if journal:
+            journal.close()
+
+    return summary
+
+
+def fetched_indexes(csv_filename):
+    """
+    Return (done, failed): the Index of each row in csv_filename (if it exists) without
+    an error, and of those whose only rows have an error.
+    """
+    done, failed = set(), set()
+    if csv_filename and os.path.isfile(csv_filename):
+        for row in csv_to_dicts(csv_filename):
+            (failed if row.get('Error') else done).add(row['Index'])
+    return done, failed - done
 
-    calc_end_page = (TOTAL_ITEMS//items_per_page) + \
-        1 if end_page == 0 else end_page
 
-    writer = OutputWriter(HEADER, csv_filename)
+def detail_order(records, store=None):
+    """
+    Return the manifest records in the order their detail pages should be fetched: if
+    store (an incremental.PageStore) is given, records never fetched before come first,
+    then the others, least recently fetched first.
+    """
+    if not store:
+        return records
 
-    for page in range(start_page, calc_end_page + 1):
-        print('============= Processing page', page)
-        url = ALLCATSGREY_COLLECTION_HOME % (page, items_per_page)
+    fetched = store.fetched_times()
+    new = [record for record in records if record['URL'] not in fetched]
+    old = sorted((record for record in records if record['URL'] in fetched),
+                 key=lambda record: fetched[record['URL']])
+    return new + old
 
-        index = (page-1) * items_per_page + 1
-        index_list = scrape_index_data(url)
-        page_data = []
-        try:
-            for i, item in enumerate(index_list):
-                try:
-                    page_data.append(scrape_page_data(item['url'], index + i))
-                except Exception as e:
-                    print('Error fetching page', item, e)
-                    traceback.print_exc()
-        finally:
-            writer.as_csv(page_data)
 
-        time.sleep(sleep)
+def get_details(csv_filename, manifest_filename, workers=DEFAULT_WORKERS, store=None,
+                delta_filename=None, output_sinks=None):
+    """
+    Second phase of a two-phase crawl: fetch the detail pages of the records in the
+    manifest written by get_index(), workers at a time, and write each row to csv_filename
+    as soon as it's done, so the rows aren't in Index order. Records already in
+    csv_filename without an error are skipped, so an interrupted run is continued by
+    running it again, after which the rows of records that failed before are removed.
+    See detail_order() for the order pages are fetched in. Return a summary of the items
+    processed.
+    """
+    summary = {'items': 0, 'errors': 0}
+
+    done, failed = fetched_indexes(csv_filename)
+    records = detail_order([record for record in csv_to_dicts(manifest_filename)
+                            if record['Index'] not in done], store)
+    metrics.set_total(len(records))
+    print(f'============= Planning to fetch {len(records)} detail pages '
+          f'({len(done)} already fetched)')
+    start_time = time.monotonic()
+
+    writer = OutputWriter(HEADER, csv_filename, sinks=output_sinks)
+    if store:
+        writer = incremental.IncrementalWriter(
+            writer, OutputWriter(HEADER, delta_filename, counter=metrics.DELTA_ROWS)
+            if delta_filename else None)
+
+    def fetch(record):
+        data = fetch_page_data(record['URL'], int(record['Index']), store)
+        if 'Error' in data:
+            # so the record can be identified without the detail page
+            data.setdefault('Title', record['Title'])
+            data.setdefault('Call Number', record['Call Number'])
+        return data
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    remaining = iter(records)
+    try:
+        # only a few pages are queued at a time so rows are written as pages arrive
+        pending = {executor.submit(fetch, record)
+                   for record in itertools.islice(remaining, 2 * max(1, workers))}
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                data = future.result()
+                writer.write(data)
+                summary['items'] += 1
+                if 'Error' in data:
+                    summary['errors'] += 1
+                if summary['items'] % REPORT_EVERY == 0:
+                    print_eta(summary['items'], len(records), start_time)
+            pending.update(executor.submit(fetch, record)
+                           for record in itertools.islice(remaining, len(finished)))
+    finally:
+        writer.close()
+        executor.shutdown(cancel_futures=True)
+        if failed:
+            # the records that failed before now have a newer row (unless the run stopped
+            # before reaching them)
+            removed = compact_csv_file(csv_filename, 'Index')
+            print(f'============= Removed {removed} rows replaced by records fetched again')
+
+    print_eta(summary['items'], len(records), start_time)
+    return summary
+
+
+def print_eta(done, planned, start_time):
+    elapsed = time.monotonic() - start_time
+    rate = done / elapsed if elapsed else 0
+    remaining = max(planned - done, 0)
+    eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate)) if rate else 'unknown'
+    print(f'============= {done}/{max(planned, done)} items, {rate:.2f} items/sec, ETA {eta}')
+
+
+def collection_size():
+    """Return the number of items in the collection; TOTAL_ITEMS if it can't be found."""
+    total_items = discover_total_items()
+    if total_items is None:
+        print(f'Warning: could not find the number of items in the collection; assuming {TOTAL_ITEMS}')
+        return TOTAL_ITEMS
+
+    print('============= The collection has', total_items, 'items')
+    return total_items
+
+
+def end_page_for(end_page, items_per_page, total_items=None):
+    if end_page != 0:
+        return end_page
+    return -(-(total_items or TOTAL_ITEMS) // items_per_page)
+
+
+def shard_filename(filename, shard):
+    return f'{filename}.shard-{shard}' if filename else None
+
+
+def shard_ranges(start_page, end_page, shards):
+    """Split pages start_page to end_page into at most shards contiguous (start, end) ranges."""
+    pages = end_page - start_page + 1
+    size, extra = divmod(pages, shards)
+    result = []
+    first = start_page
+    for shard in range(min(shards, pages)):
+        last = first + size - 1 + (1 if shard < extra else 0)
+        result.append((first, last))
+        first = last + 1
+    return result
+
+
+def run_shard(args, shard, start_page, end_page, progress_queue):
+    """Scrape one shard's pages in a child process; see get_all_data_sharded()."""
+    http_client.configure_from_args(args)
+    rate_limiter.configure_from_args(args, args.sleep)
+    set_parser(args.parser)
+    if args.workers > 1:
+        set_host_limits(args.max_per_host)
+    store = incremental.open_store_from_args(args, shared=True)
+
+    def progress(page, items, errors):
+        progress_queue.put((shard, page, items, errors))
+
+    try:
+        return get_all_data(shard_filename(args.output, shard), start_page, end_page,
+                            args.items_per_page, args.workers, args.resume,
+                            store, shard_filename(args.delta, shard), progress)
+    finally:
+        downloader.close_all()
+        if store:
+            store.close()
+        if args.metrics:
+            metrics.write_summary(shard_filename(args.metrics, shard))
+
+
+def get_all_data_sharded(args):
+    """
+    Split the pages into args.shards ranges and scrape each range in its own process,
+    writing to its own file (<csv>.shard-<n>). When all shards have finished, the shard
+    files are merged, in Index order, into the CSV file. If a shard fails, the shard files
+    are kept so that the run can be continued with --resume.
+    """
+    total_items = collection_size() if args.end_page == 0 else None
+    ranges = shard_ranges(args.start_page,
+                          end_page_for(args.end_page, args.items_per_page, total_items),
+                          args.shards)
+    total_pages = sum(last - first + 1 for first, last in ranges)
+    done = {'pages': 0, 'items': 0, 'errors': 0}
+    metrics.set_total(total_pages * args.items_per_page)
+
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+        progress_queue = manager.Queue()
+        futures = {executor.submit(run_shard, args, shard, first, last, progress_queue): shard
+                   for shard, (first, last) in enumerate(ranges)}
+        for shard, (first, last) in enumerate(ranges):
+            print(f'============= Shard {shard}: pages {first} to {last}')
+
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=1)
+            while not progress_queue.empty():
+                shard, page, items, errors = progress_queue.get()
+                done['pages'] += 1
+                done['items'] += items
+                done['errors'] += errors
+                # rows are written in the shards' processes; count them here for --progress
+                metrics.count(metrics.ROWS, items)
+                print(f'============= Shard {shard} saved page {page}; total '
+                      f'{done["pages"]}/{total_pages} pages, {done["items"]} items, '
+                      f'{done["errors"]} errors')
+
+        failed = []
+        for future, shard in sorted(futures.items(), key=lambda f: f[1]):
+            try:
+                summary = future.result()
+                print(f'Shard {shard}: {summary["pages"]} pages, {summary["items"]} items, '
+                      f'{summary["errors"]} errors')
+            except Exception as e:
+                print(f'Shard {shard} failed:', e)
+                failed.append(shard)
+
+    if failed:
+        print('Not merging shard files since shards', failed, 'failed. Use --resume to continue.')
+        return
+
+    for filename in (args.output, args.delta):
+        if filename:
+            shard_files = [shard_filename(filename, shard) for shard in range(len(ranges))]
+            merge_csv_files(shard_files, filename, 'Index',
+                            sinks=sinks.open_sinks(args, HEADER, SQLITE_TABLE)
+                            if filename == args.output else None)
+            for shard_file in shard_files:
+                for f in (shard_file, shard_file + JOURNAL_SUFFIX):
+                    if os.path.isfile(f):
+                        os.remove(f)
 
 
 def setup_command_line():
@@ -158,14 +615,38 @@ def setup_command_line():
                          'to if it exists (default output is to console)')
     cmdline.add_argument('--start-page', type=int, default=DEFAULT_START_PAGE,
                          help=f'First page to scrape data from (default is {DEFAULT_START_PAGE})')
-    cmdline.add_argument('--end-page', type=int, default=DEFAULT_END_PAGE,
-                         help=f'Last page to scrape episodes from (default is {DEFAULT_END_PAGE}). Set to 0 for all pages.')
-    cmdline.add_argument('--items-per-page', type=int, default=DEFAULT_ITEMS_PER_PAGE,
-                         help=f'For each page, fetch this many entries (default is {DEFAULT_ITEMS_PER_PAGE})')
-    cmdline.add_argument('--sleep', type=int, default=DEFAULT_SLEEP,
-                         help=f'Time to pause (in seconds) between fetching pages (default is {DEFAULT_SLEEP} seconds)')
+    cmdline.add_argument('--end-page', type=int,
+                         help=f'Last page to scrape episodes from (default is {DEFAULT_END_PAGE}, or 0 with --index-only). Set to 0 for all pages.')
+    cmdline.add_argument('--items-per-page', type=int,
+                         help=f'For each page, fetch this many entries (default is {DEFAULT_ITEMS_PER_PAGE}, or {DEFAULT_INDEX_ITEMS_PER_PAGE} with --index-only)')
+    cmdline.add_argument('--sleep', type=float, default=DEFAULT_SLEEP,
+                         help='Time (in seconds) between requests to the site at the start; the '
+                         'rate then adapts to how the site responds, up to --max-rate (default '
+                         f'is {DEFAULT_SLEEP} seconds)')
+    cmdline.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                         help=f'Number of detail pages to fetch concurrently for each index page, or '
+                         f'of pages to fetch concurrently with --index-only or --manifest (default is {DEFAULT_WORKERS})')
+    cmdline.add_argument('--max-per-host', type=int, default=DEFAULT_MAX_PER_HOST,
+                         help=f'When --workers > 1, maximum concurrent requests to a host (default is {DEFAULT_MAX_PER_HOST})')
+    cmdline.add_argument('--shards', type=int, default=DEFAULT_SHARDS,
+                         help=f'Split the pages into this many ranges and scrape them in separate processes, '
+                         f'then merge the results (requires --csv; default is {DEFAULT_SHARDS})')
     cmdline.add_argument('--url', dest='url', help='URL of the page to scrape. If specified, the other options are ignored.')
-
+    cmdline.add_argument('--resume', action='store_true', default=False,
+                         help='Continue an interrupted run, skipping pages already saved in the CSV file (requires --csv)')
+    phase = cmdline.add_mutually_exclusive_group()
+    phase.add_argument('--index-only', action='store_true', default=False,
+                       help='Only read the index pages and save each item\'s Index, title, URL, source '
+                       'and call number in the CSV file, a manifest for --manifest')
+    phase.add_argument('--manifest',
+                       help='Fetch the detail pages of the items in this manifest (made with '
+                       '--index-only), in any order, skipping items already in the CSV file')
+    add_parser_argument(cmdline)
+    sinks.add_arguments(cmdline)
+    incremental.add_arguments(cmdline)
+    http_client.add_arguments(cmdline)
+    rate_limiter.add_arguments(cmdline)
+    metrics.add_arguments(cmdline)
 
     return cmdline
 
@@ -175,12 +656,73 @@ def main():
     Processing begins here if script run directly
     """
     args = setup_command_line().parse_args()
+    if args.end_page is None:
+        args.end_page = 0 if args.index_only else DEFAULT_END_PAGE
+    if args.items_per_page is None:
+        args.items_per_page = DEFAULT_INDEX_ITEMS_PER_PAGE if args.index_only else DEFAULT_ITEMS_PER_PAGE
+    if (args.index_only or args.manifest) and args.shards > 1:
+        print('--shards can\'t be used with --index-only or --manifest')
+        sys.exit(1)
+    if args.parquet and args.resume:
+        # the Parquet file is rewritten, so it would only have the rows of the resumed run
+        print('--parquet can\'t be used with --resume')
+        sys.exit(1)
+
+    http_client.configure_from_args(args)
+    rate_limiter.configure_from_args(args, args.sleep)
+    set_parser(args.parser)
+    metrics.start_from_args(args)
+
+    if args.shards > 1 and not args.url:
+        if not args.output:
+            print('--shards requires --csv')
+            sys.exit(1)
+        if args.record:
+            # the shards' processes can't append to one recording
+            print('--record can\'t be used with --shards')
+            sys.exit(1)
+        try:
+            get_all_data_sharded(args)
+        finally:
+            metrics.finish_from_args(args)
+        return
 
-    if args.url:
-        print(scrape_page_data(args.url))
-    else:
-        get_all_data(args.output, args.start_page, args.end_page,
-                    args.items_per_page, args.sleep)
+    store = incremental.open_store_from_args(args)
+
+    try:
+        if args.url:
+            print(scrape_page_data(args.url, store=store))
+        elif args.index_only:
+            if args.workers > 1:
+                set_host_limits(args.max_per_host)
+            print(get_index(args.output, args.start_page, args.end_page, args.items_per_page,
+                            args.workers, args.resume,
+                            output_sinks=sinks.open_sinks(args, MANIFEST_HEADER,
+                                                          MANIFEST_SQLITE_TABLE)))
+        elif args.manifest:
+            if args.workers > 1:
+                set_host_limits(args.max_per_host)
+            print(get_details(args.output, args.manifest, args.workers, store, args.delta,
+                              sinks.open_sinks(args, HEADER, SQLITE_TABLE)))
+        else:
+            if args.workers > 1:
+                set_host_limits(args.max_per_host)
+            get_all_data(args.output, args.start_page, args.end_page,
+                        args.items_per_page, args.workers, args.resume,
+                        store, args.delta,
+                        output_sinks=sinks.open_sinks(args, HEADER, SQLITE_TABLE))
+    finally:
+        downloader.close_all()
+        if store:
+            print(store.summary())
+            store.close()
+        metrics.finish_from_args(args)
+
+    print(http_client.stats.summary())
+    print(rate_limiter.controller.summary())
+    if http_record.recording:
+        print(http_record.recording.summary())
+    http_record.close_recording()
 
 
 if __name__ == '__main__':
@@ -12,13 +12,27 @@ Licence: GPL v3
 import os
 import sys
 import traceback
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import argparse
 import requests
-import time
+import asyncio
 #  sys.path.append(os.path.relpath("./"))
 from utils import *
+import http_client
+import metrics
+import http_record
 from category_urls import category_urls
+from async_crawler import AsyncCrawler, DEFAULT_CONCURRENCY, DEFAULT_RATE
+import redirect_cache
+import downloader
+from checkpoint import open_journal
+import incremental
+import sinks
+import dedup
+import browser
+import pipeline
+import rate_limiter
+from redirect_cache import DEFAULT_RESOLVE_WORKERS
 
 DEFAULT_SLEEP = 3
 DEFAULT_METHOD = 'archive'
@@ -30,11 +44,16 @@ ARCHIVE_URL = 'https://allcatsrgrey.org.uk/wp/wpfb-file/cervical_screening_stand
 CATEGORY_URL = 'https://allcatsrgrey.org.uk/wp/find-grey-literature/'
 CATEGORY_URL_FILENAME = './category-urls.txt'
 
+# Only the parts of each page that are scraped are parsed
+REGION_TARGET = ParseTarget(SoupStrainer('li', class_='menu-item'), 'li.menu-item')
+ARCHIVE_TARGET = ParseTarget(SoupStrainer('div', id='secondary'), 'div#secondary')
+ARTICLES_TARGET = ParseTarget(SoupStrainer(['article', 'li']), 'article, li.previous')
+
 HEADER = ['Title', 'Date', 'Categories', 'URL', 'Download', 'Error']
 
 
 def region_urls(url):
-    soup = get_page(url)
+    soup = get_page(url, REGION_TARGET)
 
     if soup is None:
         return []
@@ -52,7 +71,7 @@ def region_urls(url):
 
 
 def archive_urls(url):
-    soup = get_page(url)
+    soup = get_page(url, ARCHIVE_TARGET)
 
     if soup is None:
         return []
@@ -83,71 +102,425 @@ def get_next_url(soup):
 items_processed = 0
 
 
-def scrape_articles_from_pages(url, do_download):
-    global items_processed
-    print('============= Processing page:', url)
+def parse_article(article):
+    """
+    Return the data for an article on an archive, region or category page. The URL is
+    the raw link from the page; see resolve_article().
+    """
+    item = {}
+    try:
+        link = article.find('a')
+        if link:
+            item['URL'] = link['href']
+            item['Title'] = link['title']
+        datetime = article.find(
+            'time', class_='entry-date published')
+        item['Date'] = datetime['datetime'] if datetime else ''
+
+        categories = article.find('span', class_='category')
+        if categories:
+            cat_links = categories.find_all('a')
+            if cat_links:
+                item['Categories'] = ';'.join(
+                    [link.text for link in cat_links])
+    except Exception as e:
+        print('Error parsing article', e)
+        traceback.print_exc()
+        item['Error'] = repr(traceback.format_exception(e))
+
+    return item
+
+
+def resolve_article(item, do_download):
+    """
+    Replace the article's URL with the URL it redirects to and, optionally, download the
+    document.
+    """
+    try:
+        if 'URL' in item:
+            item['URL'] = real_url(item['URL'])
+
+            if do_download:
+                item['Download'] = download_file(item['URL'], DOWNLOAD_DIR)
+
+    except Exception as e:
+        print('Error fetching page', item.get('URL'), e)
+        traceback.print_exc()
+        item['Error'] = repr(traceback.format_exception(e))
+
+    return item
+
+
+def drop_seen(items, dedup, source):
+    """
+    Return the articles that dedup (a dedup.DedupIndex) hasn't seen before, checking
+    their URLs (before resolution) and titles. Articles with errors are kept.
+    """
+    return [item for item in items
+            if 'Error' in item or not dedup.seen(source, [item.get('URL')], item.get('Title'))]
+
+
+def record_seen(items, raw_urls, dedup, source, held=None):
+    """
+    Return the articles whose resolved URLs dedup hasn't seen before and hold them (by
+    raw and resolved URL) as seen by source. The entries to save once the articles have
+    been written are added to held; if held is None, they're saved now. Articles with
+    errors are kept but not recorded, so they're tried again next time.
+    """
+    result = []
+    entries = []
+    for item, raw_url in zip(items, raw_urls):
+        if 'Error' not in item:
+            if dedup.seen(source, [item.get('URL')]):
+                continue
+            entries += dedup.hold(source, [raw_url, item.get('URL')], item.get('Title'))
+        result.append(item)
+    if held is None:
+        dedup.save(entries)
+    else:
+        held.extend(entries)
+    return result
+
+
+def resolve_articles(items, do_download, workers=DEFAULT_RESOLVE_WORKERS, dedup=None,
+                     source=None, held=None):
+    """
+    Batch version of resolve_article(): the redirects for all the items are resolved
+    concurrently (or taken from the redirect cache), then the documents are downloaded
+    concurrently. Return the items to output: if dedup is given, documents already seen
+    are left out before they are resolved or downloaded; see record_seen() for held.
+    """
+    if dedup:
+        items = drop_seen(items, dedup, source)
+    raw_urls = [item.get('URL') for item in items]
+
+    to_resolve = [item for item in items if 'URL' in item and 'Error' not in item]
+    resolved = real_urls([item['URL'] for item in to_resolve], workers)
+
+    for item in to_resolve:
+        result = resolved[item['URL']]
+        if isinstance(result, Exception):
+            print('Error fetching page', item['URL'], result)
+            item['Error'] = repr(traceback.format_exception(result))
+        else:
+            item['URL'] = result
+
+    if dedup:
+        items = record_seen(items, raw_urls, dedup, source, held)
+
+    if do_download:
+        download_articles(items)
+
+    return items
+
+
+def download_articles(items):
+    """Download the documents for the resolved items concurrently."""
+    to_download = [item for item in items
+                   if 'URL' in item and 'Error' not in item and item['URL']]
+    for item, result in zip(to_download,
+                            download_files([item['URL'] for item in to_download],
+                                           DOWNLOAD_DIR)):
+        if result.status == downloader.FAILED:
+            print('Error downloading', item['URL'], result.error)
+            item['Download'] = f'Error downloading {item["URL"]}: {result.error}'
+        else:
+            item['Download'] = result.path
+
+
+def fetch_listing_page(page_url, store=None):
+    """
+    Return (soup, record) for a page of articles. If store (an incremental.PageStore) is
+    given and the page hasn't changed since the last run, soup is None and record is the
+    saved {'items': ..., 'next': ...} for the page.
+    """
+    if store:
+        soup, record = get_page_incremental(page_url, store, ARTICLES_TARGET)
+        if record is not None:
+            record['items'] = [dict(item, **{incremental.STATUS: incremental.UNCHANGED})
+                               for item in record['items']]
+        return soup, record
+
+    return get_page(page_url, ARTICLES_TARGET), None
+
+
+# PageStore -> URLs of the articles saved in it; see stored_article_urls()
+article_urls = {}
+
+
+def stored_article_urls(store):
+    """
+    Return the set of URLs of the articles on all the pages saved in store. It's read
+    once per run and then kept up to date by save_listing_page().
+    """
+    if store not in article_urls:
+        article_urls[store] = {item.get('URL') for record in store.records()
+                               for item in record.get('items', [])}
+    return article_urls[store]
+
+
+def save_listing_page(store, page_url, items, next_url):
+    """
+    Save the articles scraped from a changed page in store and tag each article as new
+    or unchanged. An article is unchanged if it was saved before on any page, since
+    articles move to later pages as new ones are added.
+    """
+    known_urls = stored_article_urls(store)
+    for item in items:
+        item[incremental.STATUS] = (incremental.UNCHANGED if item.get('URL') in known_urls
+                                    else incremental.NEW)
+
+    keep = not any('Error' in item for item in items)
+    store.save(page_url,
+               {'items': [incremental.strip_status(item) for item in items], 'next': next_url},
+               keep)
+    if keep:
+        known_urls.update(item.get('URL') for item in items)
+
+
+class ListingPage:
+    """A page of articles as it passes through the stages of scrape_articles_from_pages()."""
+
+    def __init__(self, url, next_url, soup=None, record=None):
+        self.url = url
+        self.next = next_url
+        self.soup = soup
+        # the data saved for the page if it hasn't changed; see fetch_listing_page()
+        self.record = record
+        self.items = []
+        # dedup entries to save once the items have been written; see record_seen()
+        self.held = []
+
+
+def fetch_listing_pages(url, journal=None, store=None):
+    """
+    Yield a ListingPage for url and each page that follows it, skipping pages already
+    completed in journal. The pages have to be fetched in turn since each has the link to
+    the next one.
+    """
     next_url = url
-    article_list = []
     while next_url:
-        soup = get_page(next_url)
-        print('      ----- Processing next page', next_url)
-        if soup:
-            articles = soup.find_all('article')
-            if articles:
-                for article in articles:
-                    item = {}
-                    try:
-                        link = article.find('a')
-                        if link:
-                            item['URL'] = real_url(link['href'])
-                            item['Title'] = link['title']
-                        datetime = article.find(
-                            'time', class_='entry-date published')
-                        item['Date'] = datetime['datetime'] if datetime else ''
-
-                        categories = article.find('span', class_='category')
-                        if categories:
-                            cat_links = categories.find_all('a')
-                            if cat_links:
-                                item['Categories'] = ';'.join(
-                                    [link.text for link in cat_links])
-
-                        if do_download and 'URL' in item:
-                            item['Download'] = download_file(
-                                item['URL'], DOWNLOAD_DIR)
-
-                    except Exception as e:
-                        print('Error fetching page', url, e)
-                        traceback.print_exc()
-                        item['Error'] = repr(traceback.format_exception(e))
-
-                    items_processed += 1
-                    article_list.append(item)
-
+        page_url = next_url
+        done = journal.get('page', page_url) if journal else None
+        if done:
+            print('      ----- Skipping completed page', page_url)
+            next_url = done['next']
+            continue
+
+        soup, record = fetch_listing_page(page_url, store)
+        print('      ----- Processing next page', page_url)
+        if record is not None:
+            next_url = record['next']
+        elif soup:
             next_url = get_next_url(soup)
         else:
             print('Warning: No soup found for archive month url', url)
-            break
+            return
+
+        yield ListingPage(page_url, next_url, soup, record)
+
+
+@metrics.timed('scrape_articles_from_pages')
+def scrape_articles_from_pages(url, do_download, resolve_workers=DEFAULT_RESOLVE_WORKERS,
+                               writer=None, journal=None, store=None, dedup=None,
+                               source=None, stage_workers=pipeline.DEFAULT_WORKERS):
+    """
+    Scrape the articles on url and on the pages that follow it. If writer is given, each
+    page's articles are written as soon as the page is done (and checkpointed in journal,
+    if given) and an empty list is returned. Otherwise, all the articles are returned.
+    If store is given, unchanged pages are not parsed again; see fetch_listing_page().
+    If dedup is given, articles already seen are skipped; source is the method (eg
+    archive) used to find them.
+
+    Pages stream through the stages fetch -> parse -> resolve -> download -> write, so
+    later pages are fetched while earlier ones are resolved. The resolve and download
+    stages work on up to stage_workers pages at a time, and only a few pages are held
+    in memory however many there are.
+    """
+    global items_processed
+    print('============= Processing page:', url)
+
+    def parse(page):
+        if page.record is not None:
+            page.items = page.record['items']
+            if dedup:
+                page.items = drop_seen(page.items, dedup, source)
+        else:
+            page.items = [parse_article(article) for article in page.soup.find_all('article')]
+        page.soup = None
+        return page
+
+    def resolve(page):
+        if page.record is None and page.items:
+            page.items = resolve_articles(page.items, False, resolve_workers, dedup, source,
+                                          page.held)
+        return page
+
+    def download(page):
+        if page.record is None and page.items:
+            download_articles(page.items)
+        return page
+
+    stages = [pipeline.Stage('parse', parse, 1),
+              pipeline.Stage('resolve', resolve, stage_workers)]
+    if do_download:
+        stages.append(pipeline.Stage('download', download, stage_workers))
+
+    article_list = []
+    for page in pipeline.run_pipeline(fetch_listing_pages(url, journal, store), stages):
+        if store and page.record is None:
+            save_listing_page(store, page.url, page.items, page.next)
+
+        items_processed += len(page.items)
+        if writer:
+            writer.as_csv(page.items)
+            if journal:
+                journal.record('page', page.url, writer.checkpoint(), next=page.next)
+            elif page.held:
+                writer.flush()
+        else:
+            article_list.extend(page.items)
+        if dedup:
+            # only now, so that a resumed run doesn't skip articles whose rows were lost
+            dedup.save(page.held)
 
     print(items_processed, 'items processed')
     return article_list
 
 
-def scrape_all_articles(csv_filename, sleep, urls, do_download):
-    writer = OutputWriter(HEADER, csv_filename)
+@metrics.timed('scrape_all_articles')
+def scrape_all_articles(csv_filename, urls, do_download,
+                        resolve_workers=DEFAULT_RESOLVE_WORKERS, resume=False,
+                        store=None, delta_filename=None, output_sinks=None, dedup=None,
+                        source=None, stage_workers=pipeline.DEFAULT_WORKERS):
+    journal = open_journal(csv_filename, resume)
+
+    try:
+        with open_writer(csv_filename, store, delta_filename, output_sinks) as writer:
+            for url in urls:
+                if journal and journal.is_done('url', url):
+                    print('============= Skipping completed page:', url)
+                    continue
+
+                try:
+                    scrape_articles_from_pages(url, do_download, resolve_workers, writer,
+                                               journal, store, dedup, source, stage_workers)
+                    if journal:
+                        journal.record('url', url, writer.checkpoint())
+                    #  break # uncomment to stop after first page (for testing)
+                except Exception as e:
+                    print('Error fetching page', url, e)
+                    traceback.print_exc()
+    finally:
+        if journal:
+            journal.close()
+
+
+def open_writer(csv_filename, store=None, delta_filename=None, output_sinks=None):
+    writer = OutputWriter(HEADER, csv_filename, sinks=output_sinks)
+    if store:
+        writer = incremental.IncrementalWriter(
+            writer, OutputWriter(HEADER, delta_filename, counter=metrics.DELTA_ROWS)
+            if delta_filename else None)
+    return writer
+
+
+@metrics.timed('scrape_articles_from_pages_async')
+async def scrape_articles_from_pages_async(crawler, writer, url, do_download, journal=None,
+                                           store=None, dedup=None, source=None):
+    """
+    Asynchronous version of scrape_articles_from_pages(). The next page is fetched while
+    the articles on the current page are being resolved. Each page's articles are written
+    as soon as they have been resolved.
+    """
+    global items_processed
+
+    async def resolve_page(page_url, items, next_url):
+        if dedup:
+            items = drop_seen(items, dedup, source)
+        raw_urls = [item.get('URL') for item in items]
+        await asyncio.gather(*[crawler.run(item.get('URL'), resolve_article, item, do_download)
+                               for item in items if 'Error' not in item])
+        held = []
+        if dedup:
+            items = record_seen(items, raw_urls, dedup, source, held)
+        if store:
+            save_listing_page(store, page_url, items, next_url)
+        write_page(page_url, items, next_url, held)
+
+    def write_page(page_url, items, next_url, held=None):
+        writer.as_csv(items)
+        if journal:
+            journal.record('page', page_url, writer.checkpoint(), next=next_url)
+        elif held:
+            writer.flush()
+        if held:
+            # only now, so that a resumed run doesn't skip articles whose rows were lost
+            dedup.save(held)
+
+    print('============= Processing page:', url)
+    next_url = url
+    pending = []
+    while next_url:
+        page_url = next_url
+        done = journal.get('page', page_url) if journal else None
+        if done:
+            print('      ----- Skipping completed page', page_url)
+            next_url = done['next']
+            continue
+
+        soup, record = await crawler.run(page_url, fetch_listing_page, page_url, store)
+        print('      ----- Processing next page', page_url)
+        if record is not None:
+            items = drop_seen(record['items'], dedup, source) if dedup else record['items']
+            items_processed += len(items)
+            next_url = record['next']
+            write_page(page_url, items, next_url)
+            continue
+
+        if not soup:
+            print('Warning: No soup found for archive month url', url)
+            break
+
+        items = [parse_article(article) for article in soup.find_all('article')]
+        items_processed += len(items)
+        next_url = get_next_url(soup)
+        pending.append(asyncio.create_task(resolve_page(page_url, items, next_url)))
+
+    await asyncio.gather(*pending)
+
+
+@metrics.timed('scrape_all_articles_async')
+async def scrape_all_articles_async(csv_filename, urls, do_download, concurrency, rate,
+                                    resume=False, store=None, delta_filename=None,
+                                    output_sinks=None, dedup=None, source=None):
+    journal = open_journal(csv_filename, resume)
+    writer = open_writer(csv_filename, store, delta_filename, output_sinks)
+    crawler = AsyncCrawler(concurrency, rate)
+
+    async def scrape(url):
+        if journal and journal.is_done('url', url):
+            print('============= Skipping completed page:', url)
+            return
 
-    for url in urls:
-        data = []
         try:
-            data = scrape_articles_from_pages(url, do_download)
-            #  break # uncomment to stop after first page (for testing)
+            await scrape_articles_from_pages_async(crawler, writer, url, do_download, journal,
+                                                   store, dedup, source)
+            if journal:
+                journal.record('url', url, writer.checkpoint())
         except Exception as e:
             print('Error fetching page', url, e)
             traceback.print_exc()
-        finally:
-            writer.as_csv(data)
 
-        time.sleep(sleep)
+    try:
+        await asyncio.gather(*[scrape(url) for url in urls])
+    finally:
+        crawler.close()
+        writer.close()
+        if journal:
+            journal.close()
+
+    print(items_processed, 'items processed')
 
 
 def setup_command_line():
@@ -158,14 +531,38 @@ def setup_command_line():
     cmdline.add_argument('--csv', dest='output',
                          help='Filename of CSV file (tab-separated). The file will be appended '
                          'to if it exists (default output is to console)')
-    cmdline.add_argument('--sleep', type=int, default=DEFAULT_SLEEP,
-                         help=f'Time to pause (in seconds) between fetching pages (default is {DEFAULT_SLEEP} seconds)')
+    cmdline.add_argument('--sleep', type=float, default=DEFAULT_SLEEP,
+                         help='Time (in seconds) between requests to the site at the start; the '
+                         'rate then adapts to how the site responds, up to --max-rate (default '
+                         f'is {DEFAULT_SLEEP} seconds)')
     cmdline.add_argument(
         '--url', dest='url', help='URL of the page to scrape. If specified, the other options are ignored.')
     cmdline.add_argument('--method', dest='method',
                          help=f'Grab document data either from archive, region, or category section of website (default is {DEFAULT_METHOD})')
     cmdline.add_argument('--download', dest='download', action='store_true',
                          default=DEFAULT_DOWNLOAD, help=f'Download files (default is {DEFAULT_DOWNLOAD})')
+    cmdline.add_argument('--download-workers', type=int, default=downloader.DEFAULT_WORKERS,
+                         help=f'With --download, number of files to download at the same time (default is {downloader.DEFAULT_WORKERS})')
+    cmdline.add_argument('--stage-workers', type=int, default=pipeline.DEFAULT_WORKERS,
+                         help='Number of pages whose articles are resolved (and downloaded) at the '
+                         f'same time (default is {pipeline.DEFAULT_WORKERS})')
+    cmdline.add_argument('--async', dest='use_async', action='store_true', default=False,
+                         help='Fetch pages for many archive/region/category URLs at the same time')
+    cmdline.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                         help=f'With --async, maximum number of requests in progress (default is {DEFAULT_CONCURRENCY})')
+    cmdline.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                         help=f'With --async, requests per second to a host at the start, instead of --sleep (default is {DEFAULT_RATE})')
+    cmdline.add_argument('--resume', action='store_true', default=False,
+                         help='Continue an interrupted run, skipping pages already saved in the CSV file (requires --csv)')
+    add_parser_argument(cmdline)
+    sinks.add_arguments(cmdline)
+    dedup.add_arguments(cmdline)
+    incremental.add_arguments(cmdline)
+    http_client.add_arguments(cmdline)
+    redirect_cache.add_arguments(cmdline)
+    browser.add_arguments(cmdline)
+    rate_limiter.add_arguments(cmdline)
+    metrics.add_arguments(cmdline)
 
     return cmdline
 
@@ -175,23 +572,68 @@ def main():
     Processing begins here if script run directly
     """
     args = setup_command_line().parse_args()
+    if args.parquet and args.resume:
+        # the Parquet file is rewritten, so it would only have the rows of the resumed run
+        print('--parquet can\'t be used with --resume')
+        sys.exit(1)
+    http_client.configure_from_args(args)
+    rate_limiter.configure_from_args(args, args.sleep)
+    set_parser(args.parser)
+    metrics.start_from_args(args)
+    redirect_cache.open_cache_from_args(args)
+    browser.configure_from_args(args)
+    downloader.set_workers(args.download_workers)
+    store = incremental.open_store_from_args(args)
+    seen = dedup.open_index_from_args(args)
 
-    if args.url:
-        print(scrape_articles_from_pages(args.url, args.download))
-    else:
-        if args.method == 'archive':
-            urls = archive_urls(ARCHIVE_URL)
-        elif args.method == 'region':
-            urls = region_urls(REGION_URL)
-        elif args.method == 'category':
-            # uncomment to regenerate category urls. Warning: this is slow!
-            #  urls = category_urls(CATEGORY_URL, CATEGORY_URL_FILENAME, True )
-            urls = category_urls(CATEGORY_URL, CATEGORY_URL_FILENAME)
+    try:
+        if args.url:
+            print(scrape_articles_from_pages(args.url, args.download, args.resolve_workers,
+                                             store=store, dedup=seen, source='url',
+                                             stage_workers=args.stage_workers))
         else:
-            print('Invalid method specified. Must be archive or region')
-            sys.exit(1)
-
-        scrape_all_articles(args.output, args.sleep, urls, args.download)
+            if args.method == 'archive':
+                urls = archive_urls(ARCHIVE_URL)
+            elif args.method == 'region':
+                urls = region_urls(REGION_URL)
+            elif args.method == 'category':
+                # uncomment to regenerate category urls. Warning: this is slow!
+                #  urls = category_urls(CATEGORY_URL, CATEGORY_URL_FILENAME, True )
+                urls = category_urls(CATEGORY_URL, CATEGORY_URL_FILENAME)
+            else:
+                print('Invalid method specified. Must be archive or region')
+                sys.exit(1)
+
+            if args.use_async:
+                # the crawler enforces the politeness limits
+                set_host_limits(args.concurrency, pace=False)
+                asyncio.run(scrape_all_articles_async(args.output, urls, args.download,
+                                                      args.concurrency, args.rate, args.resume,
+                                                      store, args.delta,
+                                                      sinks.open_sinks(args, HEADER, args.method),
+                                                      seen, args.method))
+            else:
+                set_host_limits(max(args.resolve_workers, args.download_workers))
+                scrape_all_articles(args.output, urls, args.download,
+                                    args.resolve_workers, args.resume, store, args.delta,
+                                    sinks.open_sinks(args, HEADER, args.method),
+                                    seen, args.method, args.stage_workers)
+    finally:
+        redirect_cache.close_cache()
+        downloader.close_all()
+        if store:
+            print(store.summary())
+            store.close()
+        if seen:
+            print(seen.summary())
+            seen.close()
+        metrics.finish_from_args(args)
+
+    print(http_client.stats.summary())
+    print(rate_limiter.controller.summary())
+    if http_record.recording:
+        print(http_record.recording.summary())
+    http_record.close_recording()
 
 
 if __name__ == '__main__':
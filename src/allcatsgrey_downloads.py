@@ -7,64 +7,120 @@ Licence: GPL v3
 
 This uses selenium and the ChromeDriver unlike the other code in the project, which uses just
 BeautifulSoup. I couldn't find a way of triggering the change event for the Select control on
-the page and submitting the form. 
+the page and submitting the form. With --http, the treeview is read without a browser
+(see treeview_crawler.py) and selenium isn't needed.
 
-
-This requires Chrome and the ChromeDriver from:
-    https://googlechromelabs.github.io/chrome-for-testing/
-Change the two paths below to where you saved the chrome driver and chrome.
+The browser is created by browser.py; see there for setting where Chrome and the
+ChromeDriver are.
 =============================================================================
 """
 
 import os
 import argparse
 import traceback
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import Select  # Import the Select class
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.keys import Keys
 import time
 from utils import *
-from bs4 import BeautifulSoup
+import sinks
+import dedup
+import http_client
+import metrics
+import http_record
+import treeview_crawler
+import browser
+import rate_limiter
 
 DEFAULT_SLEEP = 60
+# The time we wait for a folder to load adapts to how long folders have taken: it's
+# TIMEOUT_FACTOR times the 95th percentile of load times, between MIN_TIMEOUT and --sleep.
+MIN_TIMEOUT = 5
+TIMEOUT_FACTOR = 5
+MIN_SAMPLES = 10
+POLL_FREQUENCY = 0.1
+# Until a folder is loaded, its list of children only holds this placeholder
+PLACEHOLDER_SELECTOR = ':scope > ul > li > span.placeholder'
+# Return [id, href, title] for each file under arguments[0]
+FILES_SCRIPT = """
+return Array.from(arguments[0].querySelectorAll('li[id^="wpfb-file"]'), function (li) {
+    var link = li.querySelector('a');
+    return link ? [li.id, link.getAttribute('href'), link.textContent] : null;
+}).filter(function (file) { return file; });
+"""
 HEADER = ['Title', 'Categories', 'URL', 'Error']
+SQLITE_TABLE = 'downloads'
+SOURCE = 'downloads'
 DOWNLOADS_TREEVIEW_URL = "https://allcatsrgrey.org.uk/wp/downloads/"
 
-WEBDRIVER_PATH = '/opt/chromedriver/chromedriver'
-CHROME_BINARY_PATH = '/opt/chromedriver/chrome-linux64/chrome'
 
+class LoadStats:
+    """Times taken for folders to load, used to adapt how long we wait for a folder."""
+
+    def __init__(self, max_timeout, min_timeout=MIN_TIMEOUT):
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.times = []
+        self.timeouts = 0
+
+    def record(self, elapsed, timed_out=False):
+        if timed_out:
+            self.timeouts += 1
+        else:
+            self.times.append(elapsed)
 
-def init_driver():
+    def percentile(self, p):
+        times = sorted(self.times)
+        return times[int(p * (len(times) - 1))] if times else 0
 
-    # Create a ChromeService instance with the executable path
-    service = ChromeService(executable_path=WEBDRIVER_PATH)
+    def timeout(self):
+        if len(self.times) < MIN_SAMPLES:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, TIMEOUT_FACTOR * self.percentile(0.95)))
 
-    # Create ChromeOptions and set the binary location
-    chrome_options = ChromeOptions()
-    chrome_options.binary_location = CHROME_BINARY_PATH
+    def summary(self):
+        if not self.times:
+            return f'Folders: none loaded, {self.timeouts} timed out'
+        return (f'Folders: {len(self.times)} loaded in {sum(self.times):.1f}s (median '
+                f'{self.percentile(0.5):.2f}s, p95 {self.percentile(0.95):.2f}s, max '
+                f'{max(self.times):.2f}s), {self.timeouts} timed out; final timeout '
+                f'{self.timeout():.1f}s')
 
-    # Comment this out to disable headless mode and see the browser on screen.
-    chrome_options.add_argument("--headless")  # Enable headless mode
 
-    # Create a Chrome webdriver instance with the service and options
-    driver = webdriver.Chrome(service=service, options=chrome_options)
+def folder_loaded(node):
+    from selenium.webdriver.common.by import By
 
-    #  driver.implicitly_wait(30)
-    return driver
+    return not node.find_elements(By.CSS_SELECTOR, PLACEHOLDER_SELECTOR)
 
 
 class Scraper:
-    def __init__(self, writer, driver, sleep):
+    def __init__(self, writer, driver, sleep, seen=None):
+        """
+        sleep is the longest time to wait for a folder to load. seen, if given, is a
+        dedup.DedupIndex used to skip files already found.
+        """
         self.writer = writer
         self.driver = driver
-        self.sleep = sleep
+        self.load_stats = LoadStats(sleep)
+        self.seen = seen
+        # ids of the files written
+        self.emitted = set()
+
+    def wait_for_folder(self, node):
+        """Wait until the children of node have loaded or the timeout passes."""
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException
+
+        timeout = self.load_stats.timeout()
+        start = time.perf_counter()
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=POLL_FREQUENCY).until(
+                lambda driver: folder_loaded(node))
+            self.load_stats.record(time.perf_counter() - start)
+        except TimeoutException:
+            print(f'Warning: folder {node.get_attribute("id")} not loaded after {timeout:.1f}s')
+            self.load_stats.record(time.perf_counter() - start, timed_out=True)
 
     def scrape_folder(self, node, node_categories=None):
+        from selenium.webdriver.common.by import By
+
         categories = ''
 
         try:
@@ -80,10 +136,9 @@ class Scraper:
             else:
                 categories = category
 
-            # provide time to retrieve children
-            time.sleep(self.sleep)
+            self.wait_for_folder(node)
 
-            self.scrape_files(node_id, 'li', categories)
+            self.scrape_files(node, categories)
 
         except Exception as e:
             print('Error fetching page', e)
@@ -92,6 +147,8 @@ class Scraper:
         self.process_subfolders(node, categories)
 
     def process_subfolders(self, parent, categories=None):
+        from selenium.webdriver.common.by import By
+
         children = parent.find_elements(By.CLASS_NAME, "hasChildren")
         for child in children:
             try:
@@ -100,37 +157,37 @@ class Scraper:
                 print('Error fetching child node', child, e)
                 traceback.print_exc()
 
-    def scrape_files(self, node_id, tag='li', categories=None):
-
-        def is_file(o):
-            if o.has_attr('id'):
-                return o['id'].startswith('wpfb-file')
-            return False
-
-        result = []
-        soup = BeautifulSoup(self.driver.page_source, 'html.parser')
-        soup_node = soup.find(tag, id=node_id)
-        #  print(soup_node)
-        if soup_node:
-            #  print(categories, soup_node['id'])
-            try:
-                children = soup_node.find_all('li')
-                #  print(len(children))
-                for child in children:
-                    if child:
-                        #  print('--------------', child)
-                        if is_file(child):
-                            link = child.find('a')
-                            url = link['href']
-                            title = link.text
-                            print(child['id'], url, title)
-                            result.append(
-                                {'Title': title, 'Categories': categories, 'URL': url})
-            except Exception as e:
-                print('Error fetching page', e)
-                traceback.print_exc()
-            finally:
-                self.writer.as_csv(result)
+    @metrics.timed('scrape_files')
+    def scrape_files(self, node, categories=None):
+        """
+        Write the files in the loaded subtree of node (a WebElement) that haven't already
+        been written. The files are read in one script call rather than by parsing the
+        whole page again.
+        """
+        try:
+            files = self.driver.execute_script(FILES_SCRIPT, node)
+        except Exception as e:
+            print('Error fetching page', e)
+            traceback.print_exc()
+            return
+
+        held = []
+        for file_id, url, title in files:
+            if file_id in self.emitted:
+                continue
+            self.emitted.add(file_id)
+            print(file_id, url, title)
+            if self.seen:
+                if self.seen.seen(SOURCE, [url], title):
+                    continue
+                held.extend(self.seen.hold(SOURCE, [url], title))
+            self.writer.write({'Title': title, 'Categories': categories, 'URL': url})
+
+        if held:
+            # only once the rows are on disk, so that a file isn't skipped for good if its
+            # row is lost
+            self.writer.flush()
+            self.seen.save(held)
 
 
 def setup_command_line():
@@ -142,26 +199,80 @@ def setup_command_line():
     cmdline.add_argument('--csv', dest='output',
                          help='Filename of CSV file (tab-separated). The file will be appended '
                          'to if it exists (default output is to console)')
-    cmdline.add_argument('--sleep', type=int, default=DEFAULT_SLEEP,
-                         help=f'Time to pause (in seconds) between fetching pages (default is {DEFAULT_SLEEP} seconds)')
+    cmdline.add_argument('--sleep', type=float, default=DEFAULT_SLEEP,
+                         help='Longest time (in seconds) to wait for a folder to load; the wait '
+                         'adapts to how long folders take to load (default is '
+                         f'{DEFAULT_SLEEP} seconds)')
+    cmdline.add_argument('--http', action='store_true', default=False,
+                         help='Request the treeview\'s folders directly over HTTP instead of '
+                         'using a browser')
+    cmdline.add_argument('--ajax-url', default=treeview_crawler.DEFAULT_AJAX_URL,
+                         help='With --http, URL the treeview requests folders from (default is '
+                         f'{treeview_crawler.DEFAULT_AJAX_URL})')
+    cmdline.add_argument('--workers', type=int, default=treeview_crawler.DEFAULT_WORKERS,
+                         help='With --http, number of folders requested at the same time '
+                         f'(default is {treeview_crawler.DEFAULT_WORKERS})')
+    sinks.add_arguments(cmdline)
+    dedup.add_arguments(cmdline)
+    http_client.add_arguments(cmdline)
+    browser.add_arguments(cmdline, recycle=False)
+    rate_limiter.add_arguments(cmdline)
+    metrics.add_arguments(cmdline)
 
     return cmdline
 
 
+def crawl_http(args, writer, seen):
+    http_client.configure_from_args(args)
+    rate_limiter.configure_from_args(args)
+    set_host_limits(args.workers)
+    crawler = treeview_crawler.TreeviewCrawler(writer, args.ajax_url, args.workers, seen)
+    try:
+        crawler.crawl()
+    finally:
+        print(crawler.summary())
+        print(http_client.stats.summary())
+        print(rate_limiter.controller.summary())
+        if http_record.recording:
+            print(http_record.recording.summary())
+        http_record.close_recording()
+
+
+def crawl_browser(args, writer, seen):
+    from selenium.webdriver.common.by import By
+
+    browser.configure_from_args(args)
+    # the walk depends on the state of the one page, so the browser can't be recycled
+    with browser.DriverManager(recycle_pages=0) as manager:
+        driver = manager.get()
+        scraper = Scraper(writer, driver, args.sleep, seen)
+
+        driver.get(DOWNLOADS_TREEVIEW_URL)
+        try:
+            treeview = driver.find_element(By.CLASS_NAME, "treeview")
+            scraper.scrape_files(treeview)
+            scraper.process_subfolders(treeview)
+        finally:
+            print(scraper.load_stats.summary())
+
+
 def main():
     args = setup_command_line().parse_args()
+    seen = dedup.open_index_from_args(args)
+    metrics.start_from_args(args)
 
-    writer = OutputWriter(HEADER, args.output)
-    driver = init_driver()
-    scraper = Scraper(writer, driver, args.sleep)
-
-    driver.get(DOWNLOADS_TREEVIEW_URL)
-    try:
-        treeview = driver.find_element(By.CLASS_NAME, "treeview")
-        scraper.scrape_files(treeview.get_attribute('id'), 'ul')
-        scraper.process_subfolders(treeview)
-    finally:
-        driver.quit()
+    with OutputWriter(HEADER, args.output,
+                      sinks=sinks.open_sinks(args, HEADER, SQLITE_TABLE)) as writer:
+        try:
+            if args.http:
+                crawl_http(args, writer, seen)
+            else:
+                crawl_browser(args, writer, seen)
+        finally:
+            if seen:
+                print(seen.summary())
+                seen.close()
+            metrics.finish_from_args(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+"""
+=============================================================================
+File: async_crawler.py
+Description: Asyncio helpers for running many blocking scraper calls at once, with a
+    global cap on concurrent calls and an adaptive limit on the request rate to each host
+    (see rate_limiter.py).
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+=============================================================================
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import rate_limiter
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 4  # initial requests per second per host
+
+
+class AsyncCrawler:
+    """
+    Runs blocking functions (eg get_page, real_url) in a thread pool. At most concurrency
+    calls are in progress at once and calls for the same host start no faster than
+    rate_limiter allows, starting at rate a second. Waiting for a turn doesn't tie up a
+    thread. If rate is 0, calls aren't paced.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE):
+        self.concurrency = concurrency
+        self.paced = rate > 0
+        if self.paced:
+            rate_limiter.configure(rate=rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def wait_turn(self, url):
+        if not self.paced or not url:
+            return
+
+        delay = rate_limiter.controller.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self, url, func, *args):
+        """Call func(*args) in the thread pool; url is the URL func will request."""
+        async with self.semaphore:
+            await self.wait_turn(url)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        self.executor.shutdown()
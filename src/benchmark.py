@@ -0,0 +1,405 @@
+"""
+=============================================================================
+File: benchmark.py
+Description: Measure how fast the scrapers crawl, using a local imitation of
+    allcatsrgrey.org.uk instead of the real site.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+The fake site has the pages the scrapers read: The Collection's index and detail pages,
+download pages and documents, the archive's month pages (with "previous" links to their
+later pages) and the article links that redirect to documents. Each response can be
+delayed (--latency) and a share of them can fail with 503 (--error-rate).
+
+Requests for allcatsrgrey.org.uk are sent to the fake site by a transport adapter, so
+the scrapers run unchanged. Each workload is run at each concurrency in a new process, so
+that its peak memory use can be measured, and items/sec, requests/sec, request latency
+(p50/p99) and peak RSS are reported.
+=============================================================================
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlunsplit, parse_qs
+from utils import *
+import http_client
+import rate_limiter
+import downloader
+import metrics
+
+SITE_HOST = 'allcatsrgrey.org.uk'
+SITE = f'https://{SITE_HOST}'
+WORKLOADS = ['collection', 'archive']
+DEFAULT_CONCURRENCY = [1, 4, 16]
+DEFAULT_ITEMS = 200
+DEFAULT_ITEMS_PER_PAGE = 10
+DEFAULT_MONTHS = 4
+DEFAULT_MONTH_PAGES = 3
+ARTICLES_PER_PAGE = 10
+DEFAULT_LATENCY = 0.05
+DEFAULT_ERROR_RATE = 0
+# Every DOWNLOAD_EVERY'th collection item has a document to download
+DOWNLOAD_EVERY = 5
+DEFAULT_DOCUMENT_SIZE = 100 * 1024
+DETAIL_HEADINGS = ['Title', 'Description', 'Author', 'Published', 'Status', 'Subject',
+                   'Category', 'Media', 'ISBN', 'Call Number', 'Type']
+ARCHIVE_YEAR = 2019
+
+ITEM_PATH = re.compile(r'^/wp/item/(\d+)/$')
+DOWNLOAD_PAGE_PATH = re.compile(r'^/wp/downloads/doc-(\d+)/$')
+DOCUMENT_PATH = re.compile(r'^/wp/wp-content/uploads/doc-(\d+)\.pdf$')
+MONTH_PATH = re.compile(r'^/wp/(\d{4})/(\d{2})/(?:page/(\d+)/)?$')
+
+
+class FakeSite:
+    """The pages of the imitation site; see SiteHandler."""
+
+    def __init__(self, items=DEFAULT_ITEMS, months=DEFAULT_MONTHS,
+                 month_pages=DEFAULT_MONTH_PAGES, document_size=DEFAULT_DOCUMENT_SIZE):
+        self.items = items
+        self.months = months
+        self.month_pages = month_pages
+        self.document = b'%PDF-1.4\n' + b'x' * max(0, document_size - 9)
+
+    def page(self, body):
+        return f'<html><head><title>All Cats R Grey</title></head><body>{body}</body></html>'
+
+    def index_page(self, pagenum, per_page):
+        first = (pagenum - 1) * per_page + 1
+        rows = ''.join(
+            f'<div class="weblib-item-row"><span class="weblib-item-index">{i}</span>'
+            f'<span class="weblib-item-thumb"></span><span class="weblib-item-title">'
+            f'<a href="{SITE}/wp/item/{i}/">Title of item {i}</a></span><br/>'
+            f'Source of item {i}<br/>Call Number:\xa0CN-{i:05}</div>'
+            for i in range(first, min(first + per_page - 1, self.items) + 1))
+        return self.page(f'<p>{self.items} items found</p>{rows}')
+
+    def detail_page(self, i):
+        if not 1 <= i <= self.items:
+            return None
+        elements = []
+        for heading in DETAIL_HEADINGS:
+            tag = 'div' if heading == 'Description' else 'span'
+            elements.append(
+                f'<span class="weblib-item-content-element">'
+                f'<span class="weblib-item-left-head">{heading}:</span>'
+                f'<{tag} class="weblib-item-left-content">{heading} of item {i} '
+                f'{"lorem ipsum " * (20 if heading == "Description" else 1)}</{tag}></span>')
+        if i % DOWNLOAD_EVERY == 0:
+            # the site's download links are to /download/ rather than /downloads/
+            elements.append(
+                '<span class="weblib-item-content-element">'
+                '<span class="weblib-item-left-head">Download:</span>'
+                '<span class="weblib-item-left-content">'
+                f'<a href="http://{SITE_HOST}/wp/download/doc-{i}/">Download Item</a></span></span>')
+        return self.page(''.join(elements) +
+                         f'<p class="weblib-item-keyword-list">keyword{i % 7}, keyword{i % 11}</p>')
+
+    def download_page(self, i):
+        return self.page(f'<p>Document {i}</p><a class="wpfb-flatbtn" '
+                         f'href="{SITE}/wp/wp-content/uploads/doc-{i}.pdf">Download</a>')
+
+    def archive_page(self, title):
+        months = ''.join(f'<li><a href="{SITE}/wp/{ARCHIVE_YEAR}/{m:02}/">Month {m}</a></li>'
+                         for m in range(1, self.months + 1))
+        return self.page(f'<h1>{title}</h1><div id="secondary"><ul>{months}</ul></div>')
+
+    def month_page(self, year, month, page):
+        if year != ARCHIVE_YEAR or not 1 <= month <= self.months or not 1 <= page <= self.month_pages:
+            return None
+        first = ((month - 1) * self.month_pages + page - 1) * ARTICLES_PER_PAGE + 1
+        articles = ''.join(
+            f'<article><h2><a href="{SITE}/wp/?p={n}" title="Article {n}">Article {n}</a></h2>'
+            f'<time class="entry-date published" datetime="{year}-{month:02}-01T10:00:00+00:00">'
+            f'</time><span class="category"><a href="{SITE}/wp/category/c{n % 5}/">Category '
+            f'{n % 5}</a></span></article>'
+            for n in range(first, first + ARTICLES_PER_PAGE))
+        previous = (f'<ul><li class="previous"><a href="{SITE}/wp/{year}/{month:02}/page/'
+                    f'{page + 1}/">Older posts</a></li></ul>' if page < self.month_pages else '')
+        return self.page(articles + previous)
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    # keep-alive, as on the real site
+    protocol_version = 'HTTP/1.1'
+    # otherwise the body waits for the client to acknowledge the headers (delayed ACK)
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if random.random() < server.error_rate:
+            return self.respond(503, server.site.page('Service unavailable'))
+
+        parts = urlsplit(self.path)
+        path, query = parts.path, parse_qs(parts.query)
+        site = server.site
+
+        if path == '/wp/find-grey-literature/' and 'pagenum' in query:
+            return self.respond(200, site.index_page(int(query['pagenum'][0]),
+                                                     int(query.get('per_page', ['10'])[0])))
+        if path == '/wp/' and 'p' in query:
+            return self.respond(302, '', {'Location': f'{SITE}/wp/wpfb-file/doc-{query["p"][0]}-pdf/'})
+        if path.startswith('/wp/wpfb-file/'):
+            return self.respond(200, site.archive_page(path))
+
+        match = ITEM_PATH.match(path)
+        if match:
+            return self.respond_page(site.detail_page(int(match.group(1))))
+        match = DOWNLOAD_PAGE_PATH.match(path)
+        if match:
+            return self.respond(200, site.download_page(int(match.group(1))))
+        match = DOCUMENT_PATH.match(path)
+        if match:
+            return self.respond(200, site.document, {'Content-Type': 'application/pdf'})
+        match = MONTH_PATH.match(path)
+        if match:
+            return self.respond_page(site.month_page(int(match.group(1)), int(match.group(2)),
+                                                     int(match.group(3) or 1)))
+
+        self.respond(404, site.page('Not found'))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def respond_page(self, page):
+        if page is None:
+            self.respond(404, self.server.site.page('Not found'))
+        else:
+            self.respond(200, page)
+
+    def respond(self, status, body, headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault('Content-Type', 'text/html; charset=UTF-8')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_site(site, latency=DEFAULT_LATENCY, error_rate=DEFAULT_ERROR_RATE):
+    """Serve site on a free local port in a background thread; return the server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SiteHandler)
+    server.daemon_threads = True
+    server.site = site
+    server.latency = latency
+    server.error_rate = error_rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SiteAdapter(http_client.TimedHTTPAdapter):
+    """Sends requests for the real site to the fake one, timing each request."""
+
+    def __init__(self, site_url, latencies, **kwargs):
+        self.site_url = urlsplit(site_url)
+        self.latencies = latencies
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        request = request.copy()
+        parts = urlsplit(original_url)
+        request.url = urlunsplit(self.site_url[:2] + parts[2:])
+        start = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+        # so that redirects and real_url() see the real site's URLs
+        response.url = original_url
+        return response
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def crawl_collection(csv_filename, folder, concurrency, args):
+    import allcatsgrey_collection
+    allcatsgrey_collection.DOWNLOAD_DIR = os.path.join(folder, 'docs')
+    pages = -(-args.items // args.items_per_page)
+    allcatsgrey_collection.get_all_data(csv_filename, 1, pages, args.items_per_page,
+                                        concurrency)
+
+
+def crawl_archive(csv_filename, folder, concurrency, args):
+    import allcatsgrey_documents
+    allcatsgrey_documents.DOWNLOAD_DIR = os.path.join(folder, 'downloads')
+    urls = allcatsgrey_documents.archive_urls(allcatsgrey_documents.ARCHIVE_URL)
+    allcatsgrey_documents.scrape_all_articles(csv_filename, urls, args.download, concurrency,
+                                              stage_workers=args.stage_workers)
+
+
+CRAWLS = {'collection': crawl_collection, 'archive': crawl_archive}
+
+
+def run_workload(workload, concurrency, site_url, options):
+    """Crawl the fake site at site_url; run in a new process. Return the measurements."""
+    args = argparse.Namespace(**options)
+    args.pool_size = max(args.pool_size, concurrency)
+    client = http_client.configure_from_args(args)
+    latencies = []
+    adapter = SiteAdapter(site_url, latencies, pool_connections=args.pool_size,
+                          pool_maxsize=args.pool_size,
+                          max_retries=client.session.get_adapter(SITE).max_retries)
+    for scheme in ('http', 'https'):
+        client.session.mount(f'{scheme}://{SITE_HOST}', adapter)
+    if args.paced:
+        rate_limiter.configure_from_args(args, 0)
+    else:
+        rate_limiter.controller.enabled = False
+    set_parser(args.parser)
+    set_host_limits(concurrency)
+
+    with tempfile.TemporaryDirectory() as folder:
+        csv_filename = os.path.join(folder, f'{workload}.csv')
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(
+                    stack.enter_context(open(os.devnull, 'w'))))
+            CRAWLS[workload](csv_filename, folder, concurrency, args)
+        elapsed = time.perf_counter() - start
+        rows = list(csv_to_dicts(csv_filename)) if os.path.isfile(csv_filename) else []
+        downloader.close_all()
+
+    return {
+        'workload': workload,
+        'concurrency': concurrency,
+        'items': len(rows),
+        'errors': sum(1 for row in rows if row.get('Error')),
+        'seconds': round(elapsed, 3),
+        'items_per_sec': round(len(rows) / elapsed, 2) if elapsed else 0,
+        'requests': len(latencies),
+        'requests_per_sec': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        # where the time went; see metrics.py
+        'metrics': metrics.registry.as_dict(),
+    }
+
+
+def print_results(results):
+    columns = ['workload', 'concurrency', 'items', 'errors', 'seconds', 'items_per_sec',
+               'requests', 'requests_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_mb']
+    widths = [max(len(column), *(len(str(r[column])) for r in results)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).rjust(width)
+                        for column, width in zip(columns, widths)))
+
+
+def setup_command_line():
+    """
+    Define command line switches
+    """
+    cmdline = argparse.ArgumentParser(prog='benchmark.py')
+    cmdline.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=WORKLOADS,
+                         help='Scrapers to run: collection (get_all_data) and/or archive '
+                         '(scrape_all_articles) (default is both)')
+    cmdline.add_argument('--concurrency', nargs='+', type=int, default=DEFAULT_CONCURRENCY,
+                         help='Numbers of concurrent requests to run each workload with: '
+                         'collection --workers and archive --resolve-workers (default is '
+                         f'{" ".join(map(str, DEFAULT_CONCURRENCY))})')
+    cmdline.add_argument('--items', type=int, default=DEFAULT_ITEMS,
+                         help=f'Number of items in the fake collection (default is {DEFAULT_ITEMS})')
+    cmdline.add_argument('--items-per-page', type=int, default=DEFAULT_ITEMS_PER_PAGE,
+                         help=f'Items on each collection index page (default is {DEFAULT_ITEMS_PER_PAGE})')
+    cmdline.add_argument('--months', type=int, default=DEFAULT_MONTHS,
+                         help=f'Number of months in the fake archive (default is {DEFAULT_MONTHS})')
+    cmdline.add_argument('--month-pages', type=int, default=DEFAULT_MONTH_PAGES,
+                         help=f'Pages of {ARTICLES_PER_PAGE} articles in each month '
+                         f'(default is {DEFAULT_MONTH_PAGES})')
+    cmdline.add_argument('--document-size', type=int, default=DEFAULT_DOCUMENT_SIZE,
+                         help=f'Size in bytes of each document (default is {DEFAULT_DOCUMENT_SIZE})')
+    cmdline.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                         help='Average time (in seconds) the fake site takes to respond; each '
+                         f'response takes between half and one and a half times this (default is {DEFAULT_LATENCY})')
+    cmdline.add_argument('--error-rate', type=float, default=DEFAULT_ERROR_RATE,
+                         help='Fraction of responses (0 to 1) that fail with 503 (default is 0)')
+    cmdline.add_argument('--download', action='store_true', default=False,
+                         help='Download the archive\'s documents too (collection documents are always downloaded)')
+    cmdline.add_argument('--stage-workers', type=int, default=2,
+                         help='Archive pages resolved at the same time (default is 2)')
+    cmdline.add_argument('--paced', action='store_true', default=False,
+                         help='Limit the rate of requests as in a real crawl (see --max-rate); '
+                         'by default requests are not paced')
+    cmdline.add_argument('--json', help='Also save the results, with the timings of each '
+                         'stage of the crawl, in this JSON file')
+    cmdline.add_argument('--verbose', action='store_true', default=False,
+                         help='Show the output of the scrapers')
+    add_parser_argument(cmdline)
+    http_client.add_arguments(cmdline)
+    rate_limiter.add_arguments(cmdline)
+
+    return cmdline
+
+
+def main():
+    """
+    Processing begins here if script run directly
+    """
+    args = setup_command_line().parse_args()
+    site = FakeSite(args.items, args.months, args.month_pages, args.document_size)
+    server = start_site(site, args.latency, args.error_rate)
+    site_url = f'http://127.0.0.1:{server.server_port}'
+    print(f'Fake site on {site_url}: {args.items} collection items, '
+          f'{args.months * args.month_pages * ARTICLES_PER_PAGE} archive articles, '
+          f'latency {args.latency}s, error rate {args.error_rate}')
+
+    results = []
+    try:
+        for workload in args.workloads:
+            for concurrency in args.concurrency:
+                # a new process for each run so that peak RSS is the run's own
+                with ProcessPoolExecutor(max_workers=1,
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(run_workload, workload, concurrency, site_url,
+                                             vars(args)).result()
+                print(f'{workload} at concurrency {concurrency}: {result["items_per_sec"]} '
+                      f'items/sec, {result["requests_per_sec"]} requests/sec')
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print()
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+=============================================================================
+File: browser.py
+Description: Create, reuse and recycle the headless Chrome browsers used by
+    category_urls.py and allcatsgrey_downloads.py.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+selenium is only imported when a browser is first needed, so scripts that don't use a
+browser (eg allcatsgrey_documents.py --method archive) don't need it installed and don't
+pay for importing it.
+
+This requires Chrome and the ChromeDriver from:
+    https://googlechromelabs.github.io/chrome-for-testing/
+Set their paths with --chromedriver and --chrome, or the CHROMEDRIVER and CHROME
+environment variables.
+=============================================================================
+"""
+import os
+import threading
+
+DEFAULT_WEBDRIVER_PATH = os.environ.get('CHROMEDRIVER', '/opt/chromedriver/chromedriver')
+DEFAULT_CHROME_BINARY_PATH = os.environ.get('CHROME', '/opt/chromedriver/chrome-linux64/chrome')
+# 0 = never recycle
+DEFAULT_RECYCLE_PAGES = 0
+
+webdriver_path = DEFAULT_WEBDRIVER_PATH
+chrome_binary_path = DEFAULT_CHROME_BINARY_PATH
+headless = True
+recycle_pages = DEFAULT_RECYCLE_PAGES
+
+
+def new_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service as ChromeService
+    from selenium.webdriver.chrome.options import Options as ChromeOptions
+
+    # Create a ChromeService instance with the executable path
+    service = ChromeService(executable_path=webdriver_path)
+
+    # Create ChromeOptions and set the binary location
+    chrome_options = ChromeOptions()
+    chrome_options.binary_location = chrome_binary_path
+
+    # Use --no-headless to see the browser on screen.
+    if headless:
+        chrome_options.add_argument("--headless")
+
+    # Create a Chrome webdriver instance with the service and options
+    return webdriver.Chrome(service=service, options=chrome_options)
+
+
+class DriverManager:
+    """
+    Holds one browser, started when it's first needed and reused after that. If
+    recycle_pages is set, the browser is restarted after that many pages have been loaded
+    (see page_loaded()) to stop its memory use growing without limit.
+    """
+
+    def __init__(self, recycle_pages=None):
+        self.recycle_pages = recycle_pages
+        self.driver = None
+        self.pages = 0
+        self.started = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.quit()
+
+    def get(self):
+        if self.driver is None:
+            self.driver = new_driver()
+            self.pages = 0
+            self.started += 1
+        return self.driver
+
+    def page_loaded(self):
+        """Call after each page is loaded; the browser is restarted if it's due."""
+        self.pages += 1
+        limit = recycle_pages if self.recycle_pages is None else self.recycle_pages
+        if limit and self.pages >= limit:
+            self.quit()
+
+    def quit(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+
+
+class DriverPool:
+    """One DriverManager per thread, for browsers shared out by a thread pool."""
+
+    def __init__(self, recycle_pages=None):
+        self.recycle_pages = recycle_pages
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.managers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.quit()
+
+    def manager(self):
+        if not hasattr(self.local, 'manager'):
+            self.local.manager = DriverManager(self.recycle_pages)
+            with self.lock:
+                self.managers.append(self.local.manager)
+        return self.local.manager
+
+    def get(self):
+        return self.manager().get()
+
+    def page_loaded(self):
+        self.manager().page_loaded()
+
+    def quit(self):
+        with self.lock:
+            for manager in self.managers:
+                manager.quit()
+
+
+def configure(driver_path=None, binary_path=None, headless_mode=None, recycle=None):
+    global webdriver_path, chrome_binary_path, headless, recycle_pages
+    if driver_path:
+        webdriver_path = driver_path
+    if binary_path:
+        chrome_binary_path = binary_path
+    if headless_mode is not None:
+        headless = headless_mode
+    if recycle is not None:
+        recycle_pages = recycle
+
+
+def add_arguments(cmdline, recycle=True):
+    """Add the browser switches; recycle is False if the script can't restart its browser."""
+    cmdline.add_argument('--chromedriver', default=DEFAULT_WEBDRIVER_PATH,
+                         help=f'Path of the ChromeDriver (default is {DEFAULT_WEBDRIVER_PATH})')
+    cmdline.add_argument('--chrome', default=DEFAULT_CHROME_BINARY_PATH,
+                         help=f'Path of Chrome (default is {DEFAULT_CHROME_BINARY_PATH})')
+    cmdline.add_argument('--no-headless', dest='headless', action='store_false', default=True,
+                         help='Show the browser on screen')
+    if recycle:
+        cmdline.add_argument('--recycle-pages', type=int, default=DEFAULT_RECYCLE_PAGES,
+                             help='Restart a browser after it has loaded this many pages to '
+                             'limit its memory use (default is 0, never)')
+    return cmdline
+
+
+def configure_from_args(args):
+    configure(args.chromedriver, args.chrome, args.headless, getattr(args, 'recycle_pages', None))
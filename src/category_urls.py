@@ -5,16 +5,14 @@ Description: Get the URLs for categories from allcatsrgrey.org.uk
 Author: Praful https://github.com/Praful/allcatsrgrey
 Licence: GPL v3
 
-This uses selenium and the ChromeDriver unlike the other code in the project, which uses just
-BeautifulSoup. I couldn't find a way of triggering the change event for the Select control on
-the page and submitting the form. 
-
-The get_category_options() method takes a long time to run. So the pre-fetched
+The category URLs are found by following the redirect for each category in the drop
+down, without submitting the form. Only if that fails does this use selenium and the
+ChromeDriver, unlike the other code in the project, which uses just BeautifulSoup: several
+browsers at a time choose each category and wait for its page to open. This still takes a while, so the pre-fetched
 category-urls.txt file should be used unless you want to regnerate the file.
 
-This requires Chrome and the ChromeDriver from:
-    https://googlechromelabs.github.io/chrome-for-testing/
-Change the two paths below to where you saved the chrome driver and chrome.
+The browsers are created by browser.py; see there for setting where Chrome and the
+ChromeDriver are.
 =============================================================================
 """
 # 
@@ -22,91 +20,126 @@ Change the two paths below to where you saved the chrome driver and chrome.
 #
 import os
 import traceback
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import Select  # Import the Select class
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.keys import Keys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from bs4 import SoupStrainer
 from utils import *
+import browser
+
+DEFAULT_BROWSERS = 4
+PAGE_TIMEOUT = 30
+# The category drop down is WordPress's categories widget. Choosing a category goes to
+# <home>/?cat=<value>, which WordPress redirects to the category's page.
+CATEGORY_QUERY = '?cat='
+CATEGORY_TARGET = ParseTarget(SoupStrainer('form'), 'form')
+
 
 def get_category_options(driver, url):
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import Select  # Import the Select class
+
     driver.get(url)
     select_element = driver.find_element(By.NAME, "cat")
 
     # Create a Select object for the select element
     return Select(select_element)
 
-def category_urls(url, filename=None, create_file=False):
-    """Scrape data from the allcatsrgrey.org.uk website.
-    Since this is a lengthy process, we check if we've saved the URL in a file 
-    unless asked to regenerate. Note that any existing file will be overwritten.
+def category_options(url):
     """
-    if not create_file and filename and os.path.isfile(filename):
-        return file_to_array(filename, True)
-
-    if create_file and not filename:
-        print('No filename provided to create category urls file')
-        return []
-
-    print('=============== Getting category URLs')
-    result = []    
-
-    webdriver_path = '/opt/chromedriver/chromedriver'
-    chrome_binary_path ='/opt/chromedriver/chrome-linux64/chrome'
-
-    # Create a ChromeService instance with the executable path
-    service = ChromeService(executable_path=webdriver_path)
+    Return (home URL, option values) of the category drop down on url, read over HTTP.
+    Return (None, []) if the drop down isn't found.
+    """
+    soup = get_page(url, CATEGORY_TARGET)
+    select = soup.find('select', attrs={'name': 'cat'}) if soup else None
+    if select is None:
+        return None, []
 
-    # Create ChromeOptions and set the binary location
-    chrome_options = ChromeOptions()
-    chrome_options.binary_location = chrome_binary_path
+    form = select.find_parent('form')
+    home = urljoin(url, form.get('action') or '') if form else None
+    values = [option.get('value') for option in select.find_all('option')]
+    return home, [v for v in values if v and v != '-1']
 
-    # Comment this out to disable headless mode and see the browser on screen.
-    chrome_options.add_argument("--headless")  # Enable headless mode
+def category_url(home, value):
+    return home.rstrip('/') + '/' + CATEGORY_QUERY + value
 
-    # Create a Chrome webdriver instance with the service and options
-    driver = webdriver.Chrome(service=service, options=chrome_options)
+def category_urls_http(home, values):
+    """
+    Return {value: URL of category} for the values whose URLs could be found by following
+    the redirect from home/?cat=<value>.
+    """
+    urls = {value: category_url(home, value) for value in values}
+    resolved = real_urls(urls.values())
+    result = {}
+    for value, url in urls.items():
+        if isinstance(resolved.get(url), Exception) or not resolved.get(url):
+            print('Error resolving', url, resolved.get(url))
+        else:
+            result[value] = resolved[url]
+    return result
 
-    # Create a Select object for the select element
-    select = get_category_options(driver, url)
-    values = [option.get_attribute("value") for option in select.options]
+def category_urls_browser(url, values, browsers=DEFAULT_BROWSERS):
+    """
+    Return {value: URL of category} by choosing each value in the drop down using a pool
+    of browsers, each waiting for the category page to open.
+    """
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
 
-    # Loop through each option in the select control
-    for value in values:
+    def choose(value):
         try:
-            #  print(value)
-            if value == "-1":
-                continue
-
             # we have to go back to the original page since the select control is 
             # stale after submitting the form.
+            driver = pool.get()
             select = get_category_options(driver, url)
-
             select.select_by_value(value)
-
-            # Wait for the page to load; adject if necessary
-            driver.implicitly_wait(2) 
-
+            WebDriverWait(driver, PAGE_TIMEOUT).until(EC.url_changes(url))
             new_url = driver.current_url
+            pool.page_loaded()
             print(new_url)
-            result.append(new_url)
-
-            #TODO just for testing
-            #  if len(result) >3:
-                #  break
+            return value, new_url
         except Exception as e:
-            print('Error processing value', e)
+            print('Error processing value', value, e)
             traceback.print_exc()
+            return value, None
 
+    with browser.DriverPool() as pool:
+        with ThreadPoolExecutor(max_workers=max(1, browsers)) as executor:
+            return {value: new_url for value, new_url in executor.map(choose, values) if new_url}
+
+def category_urls(url, filename=None, create_file=False, browsers=DEFAULT_BROWSERS):
+    """Scrape data from the allcatsrgrey.org.uk website.
+    Since this is a lengthy process, we check if we've saved the URL in a file 
+    unless asked to regenerate. Note that any existing file will be overwritten.
+    The URLs are found over HTTP where possible; otherwise browsers (up to browsers of
+    them at a time) are used to choose each category.
+    """
+    if not create_file and filename and os.path.isfile(filename):
+        return file_to_array(filename, True)
+
+    if create_file and not filename:
+        print('No filename provided to create category urls file')
+        return []
+
+    print('=============== Getting category URLs')
+    home, values = category_options(url)
+    found = category_urls_http(home, values) if home else {}
+
+    if not values:
+        # read the drop down using a browser instead
+        with browser.DriverManager() as manager:
+            select = get_category_options(manager.get(), url)
+            values = [option.get_attribute("value") for option in select.options]
+            values = [v for v in values if v and v != "-1"]
+
+    missing = [v for v in values if v not in found]
+    if missing:
+        print(f'Using browsers for {len(missing)} categories')
+        found.update(category_urls_browser(url, missing, browsers))
+
+    result = [found[v] for v in values if v in found]
 
     if create_file:
         array_to_file(filename, result)
 
-    # Close the browser
-    driver.quit()
-
     return result
@@ -0,0 +1,85 @@
+"""
+=============================================================================
+File: checkpoint.py
+Description: Journal of completed work so that an interrupted crawl can be resumed
+    (--resume) without re-fetching pages or writing duplicate rows.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+The journal is kept next to the CSV file (<csv>.journal). Each line is a JSON object
+recording a completed unit of work (eg an index page or an archive URL) and the size of
+the CSV file once its rows had been written. On resume, the CSV file is truncated to the
+last recorded size, which removes any rows written after the last checkpoint.
+=============================================================================
+"""
+import json
+import os
+
+JOURNAL_SUFFIX = '.journal'
+
+
+class Journal:
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.done = {}
+        self.offset = None
+        if resume and os.path.isfile(filename):
+            self.load()
+        self.fh = open(filename, 'a' if resume else 'w')
+
+    def load(self):
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line is incomplete if we were killed while writing it
+                    break
+                self.done[(entry['kind'], entry['key'])] = entry
+                if entry.get('offset') is not None:
+                    self.offset = entry['offset']
+
+    def is_done(self, kind, key):
+        return (kind, key) in self.done
+
+    def get(self, kind, key):
+        return self.done.get((kind, key))
+
+    def record(self, kind, key, offset=None, **extra):
+        """Record that the work identified by kind and key is complete."""
+        entry = dict(kind=kind, key=key, offset=offset, **extra)
+        self.done[(kind, key)] = entry
+        if offset is not None:
+            self.offset = offset
+        self.fh.write(json.dumps(entry) + '\n')
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        self.fh.close()
+
+
+def open_journal(csv_filename, resume=False):
+    """
+    Return the Journal for csv_filename. If resuming, the CSV file is truncated to the
+    last checkpoint. Return None if output isn't to a file since we can't resume then.
+    """
+    if not csv_filename or csv_filename == '-':
+        if resume:
+            print('Warning: --resume requires --csv; starting from the beginning')
+        return None
+
+    journal = Journal(csv_filename + JOURNAL_SUFFIX, resume)
+    size = os.path.getsize(csv_filename) if os.path.isfile(csv_filename) else 0
+
+    if journal.offset is None:
+        journal.record('start', csv_filename, size)
+    elif size > journal.offset:
+        print(f'Removing {size - journal.offset} bytes written after the last checkpoint')
+        with open(csv_filename, 'r+b') as f:
+            f.truncate(journal.offset)
+
+    if resume:
+        print(f'Resuming: {len(journal.done)} completed items in {journal.filename}')
+
+    return journal
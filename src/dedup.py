@@ -0,0 +1,160 @@
+"""
+=============================================================================
+File: dedup.py
+Description: Persistent index of the documents already seen by the archive, region,
+    category and downloads scrapers, so that documents found again (in the same run or a
+    later one) can be skipped before their redirects are resolved, they're downloaded or
+    they're output. Overlap between the sources is reported at the end of a run.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+=============================================================================
+"""
+import posixpath
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlparse, unquote
+
+DEFAULT_DEDUP_FILE = './seen-documents.sqlite'
+NEW = 'new'
+
+
+def normalise_url(url):
+    """Return url without scheme, www., fragment or trailing slash, in lower case."""
+    if not url:
+        return ''
+    parts = urlparse(url.strip().lower())
+    host = parts.netloc[4:] if parts.netloc.startswith('www.') else parts.netloc
+    path = parts.path.rstrip('/')
+    return f'{host}{path}?{parts.query}' if parts.query else f'{host}{path}'
+
+
+def url_filename(url):
+    """
+    Return the host and the file name at the end of url's path (eg
+    allcatsrgrey.org.uk/report.pdf) in lower case, or '' if it doesn't end in a file name
+    with an extension. The same file is linked from different folders, eg
+    /wp/download/<folder>/report.pdf on the archive pages and /wp/download/report.pdf on
+    the downloads page.
+    """
+    if not url:
+        return ''
+    parts = urlparse(url.strip().lower())
+    host = parts.netloc[4:] if parts.netloc.startswith('www.') else parts.netloc
+    name = posixpath.basename(unquote(parts.path))
+    stem, ext = posixpath.splitext(name)
+    return f'{host}/{name}' if stem and ext else ''
+
+
+def normalise_title(title):
+    return re.sub(r'[^a-z0-9]+', ' ', (title or '').lower()).strip()
+
+
+class DedupIndex:
+    def __init__(self, filename=DEFAULT_DEDUP_FILE, match_titles=False, match_filenames=False):
+        """
+        If match_titles is True, documents with the same title are also duplicates, and if
+        match_filenames is True, so are documents on the same host with the same file name.
+        """
+        self.match_titles = match_titles
+        self.match_filenames = match_filenames
+        self.lock = threading.Lock()
+        # stats[source] counts new documents and, for duplicates, the source they were
+        # first seen in
+        self.stats = defaultdict(Counter)
+        # fingerprint -> source of documents held but not yet saved; see hold()
+        self.held = {}
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                          '(fingerprint TEXT PRIMARY KEY, source TEXT, first_seen REAL)')
+        self.conn.commit()
+
+    def fingerprints(self, urls, title=None):
+        result = ['url:' + normalise_url(url) for url in urls if url]
+        if self.match_filenames:
+            result += ['file:' + name for name in dict.fromkeys(map(url_filename, urls)) if name]
+        if self.match_titles and normalise_title(title):
+            result.append('title:' + normalise_title(title))
+        return result
+
+    def seen(self, source, urls, title=None):
+        """
+        Return True if a document with any of urls (or title, if matching titles) has
+        been seen before, counting it as an overlap between source and where it was seen.
+        """
+        fingerprints = self.fingerprints(urls, title)
+        if not fingerprints:
+            return False
+
+        with self.lock:
+            for fingerprint in fingerprints:
+                if fingerprint in self.held:
+                    self.stats[source][self.held[fingerprint]] += 1
+                    return True
+            row = self.conn.execute(
+                'SELECT source FROM fingerprints WHERE fingerprint IN '
+                f'({", ".join("?" * len(fingerprints))}) LIMIT 1', fingerprints).fetchone()
+            if row:
+                self.stats[source][row[0]] += 1
+                return True
+            return False
+
+    def hold(self, source, urls, title=None):
+        """
+        Record a new document found by source without saving it: it's seen from now on in
+        this run, but is only seen in later runs once save() has been called with the
+        returned entries. Call save() after the document's row has been written, so that a
+        resumed run doesn't skip documents whose rows were lost.
+        """
+        entries = [(f, source) for f in self.fingerprints(urls, title)]
+        with self.lock:
+            for fingerprint, _ in entries:
+                self.held.setdefault(fingerprint, source)
+            self.stats[source][NEW] += 1
+        return entries
+
+    def save(self, entries):
+        """Save documents held by hold(); entries are the values it returned."""
+        if not entries:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany('INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)',
+                                  [(f, source, now) for f, source in entries])
+            self.conn.commit()
+            for fingerprint, _ in entries:
+                self.held.pop(fingerprint, None)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def summary(self):
+        lines = []
+        for source, counts in self.stats.items():
+            duplicates = {s: n for s, n in counts.items() if s != NEW}
+            overlap = ', '.join(f'{n} first seen in {s}' for s, n in sorted(duplicates.items()))
+            lines.append(f'Dedup {source}: {counts[NEW]} new, {sum(duplicates.values())} '
+                         f'already seen' + (f' ({overlap})' if overlap else ''))
+        return '\n'.join(lines) if lines else 'Dedup: no documents checked'
+
+
+def add_arguments(cmdline):
+    cmdline.add_argument('--dedup', action='store_true', default=False,
+                         help='Skip documents already found by this or another scraper (in this '
+                         'or an earlier run) and report the overlap between sources')
+    cmdline.add_argument('--dedup-file', default=DEFAULT_DEDUP_FILE,
+                         help=f'With --dedup, file in which seen documents are recorded (default is {DEFAULT_DEDUP_FILE})')
+    cmdline.add_argument('--dedup-titles', action='store_true', default=False,
+                         help='With --dedup, also treat documents with the same title as duplicates')
+    cmdline.add_argument('--dedup-filenames', action='store_true', default=False,
+                         help='With --dedup, also treat documents on the same host with the same '
+                         'file name (in any folder) as duplicates')
+    return cmdline
+
+
+def open_index_from_args(args):
+    return (DedupIndex(args.dedup_file, args.dedup_titles, args.dedup_filenames)
+            if args.dedup else None)
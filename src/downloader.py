@@ -0,0 +1,224 @@
+"""
+=============================================================================
+File: downloader.py
+Description: Download documents in-process, replacing one wget process per file.
+    Files are streamed to disk in chunks and saved using the same directory layout as
+    `wget -x`. Like `wget -N`, a file is only downloaded again if it has changed
+    (using If-Modified-Since and ETag). Partial downloads are resumed using Range requests.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+=============================================================================
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlparse, unquote
+import http_client
+import metrics
+
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = '.part'
+ETAG_FILENAME = '.etags.sqlite'
+# ETags were kept in this file before they were kept in ETAG_FILENAME
+JSON_ETAG_FILENAME = '.etags.json'
+# seconds to wait for another process writing ETags to the same folder
+BUSY_TIMEOUT = 60
+
+# status is one of the values below; error is set if status is FAILED
+DownloadResult = namedtuple('DownloadResult',
+                            ['url', 'path', 'bytes', 'status', 'elapsed', 'error'],
+                            defaults=[None])
+DOWNLOADED = 'downloaded'
+RESUMED = 'resumed'
+NOT_MODIFIED = 'not modified'
+FAILED = 'failed'
+
+
+def local_path(url, folder):
+    """
+    Return the path wget -x would save url to, ie folder/host/path. Like wget, . and ..
+    segments are resolved, so the path is always inside folder/host.
+    """
+    parts = urlparse(url)
+    path = unquote(parts.path)
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    if parts.query:
+        path += '?' + parts.query
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment and segment != '.':
+            segments.append(segment)
+    return os.path.join(folder, parts.netloc, *segments)
+
+
+class Downloader:
+    def __init__(self, folder, workers=DEFAULT_WORKERS, limiter=None):
+        """
+        limiter, if given, is an object whose limit(url) method returns a context manager
+        that is held while a URL is requested, eg utils.host_limiter.
+        """
+        self.folder = folder
+        self.workers = workers
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        # path -> lock held while the file is downloaded, so that two workers asked for
+        # the same URL don't both write to its partial file
+        self.path_locks = {}
+        # ETags are saved as soon as files are downloaded, in a database that other
+        # processes downloading to the same folder (eg shards) can update at the same time
+        os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(folder, ETAG_FILENAME), timeout=BUSY_TIMEOUT,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS etags (url TEXT PRIMARY KEY, etag TEXT)')
+        self.conn.commit()
+        self.import_json_etags()
+
+    def import_json_etags(self):
+        filename = os.path.join(self.folder, JSON_ETAG_FILENAME)
+        if not os.path.isfile(filename):
+            return
+        with open(filename) as f:
+            etags = json.load(f)
+        with self.lock:
+            self.conn.executemany('INSERT OR IGNORE INTO etags VALUES (?, ?)', etags.items())
+            self.conn.commit()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filename)
+
+    def etag(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT etag FROM etags WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def save_etag(self, url, etag):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO etags VALUES (?, ?)', (url, etag))
+            self.conn.commit()
+
+    def path_lock(self, path):
+        with self.lock:
+            return self.path_locks.setdefault(path, threading.Lock())
+
+    def limit(self, url):
+        return self.limiter.limit(url) if self.limiter else contextlib.nullcontext()
+
+    def request_headers(self, url, path, partial):
+        headers = {}
+        etag = self.etag(url)
+        if os.path.isfile(path):
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(path), usegmt=True)
+            if etag:
+                headers['If-None-Match'] = etag
+        elif os.path.isfile(partial):
+            headers['Range'] = f'bytes={os.path.getsize(partial)}-'
+            # only resume if the file hasn't changed since the partial download
+            if etag:
+                headers['If-Range'] = etag
+        return headers
+
+    def download(self, url):
+        start = time.perf_counter()
+        path = local_path(url, self.folder)
+        partial = path + PARTIAL_SUFFIX
+
+        def result(status, size=0, error=None):
+            return DownloadResult(url, path, size, status, time.perf_counter() - start, error)
+
+        try:
+            with self.path_lock(path):
+                return self.fetch(url, path, partial, result)
+        except Exception as e:
+            return result(FAILED, error=repr(e))
+
+    def fetch(self, url, path, partial, result):
+        """Download url to path via partial; call with the path's lock held."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        headers = self.request_headers(url, path, partial)
+
+        with self.limit(url):
+            response = http_client.get(url, headers=headers, stream=True)
+
+        with response:
+            if response.status_code == 304:
+                return result(NOT_MODIFIED)
+            if response.status_code == 416 and os.path.isfile(partial):
+                # the partial download was in fact complete
+                os.replace(partial, path)
+                return result(RESUMED)
+            if response.status_code not in (200, 206):
+                return result(FAILED, error=f'status {response.status_code}')
+
+            resumed = response.status_code == 206
+            size = 0
+            with open(partial, 'ab' if resumed else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+
+            os.replace(partial, path)
+            metrics.count('downloaded_bytes', size)
+
+            last_modified = response.headers.get('Last-Modified')
+            if last_modified:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+                os.utime(path, (mtime, mtime))
+
+            etag = response.headers.get('ETag')
+            if etag:
+                self.save_etag(url, etag)
+
+            return result(RESUMED if resumed else DOWNLOADED, size)
+
+    def download_many(self, urls):
+        """Download urls concurrently, returning results in the same order as urls."""
+        urls = list(urls)
+        if self.workers <= 1 or len(urls) <= 1:
+            return [self.download(url) for url in urls]
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(urls))) as executor:
+            return list(executor.map(self.download, urls))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+downloaders = {}
+downloaders_lock = threading.Lock()
+download_workers = DEFAULT_WORKERS
+
+
+def get_downloader(folder, limiter=None):
+    """Return the shared Downloader for folder, creating it if necessary."""
+    with downloaders_lock:
+        if folder not in downloaders:
+            downloaders[folder] = Downloader(folder, download_workers, limiter)
+        return downloaders[folder]
+
+
+def set_workers(workers):
+    global download_workers
+    with downloaders_lock:
+        download_workers = workers
+        for downloader in downloaders.values():
+            downloader.workers = workers
+
+
+def close_all():
+    """Close all downloaders; call at the end of a run."""
+    with downloaders_lock:
+        for downloader in downloaders.values():
+            downloader.close()
+        downloaders.clear()
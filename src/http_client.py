@@ -0,0 +1,271 @@
+"""
+=============================================================================
+File: http_client.py
+Description: Shared HTTP client used by the scrapers. Requests go through one pooled
+    session (keep-alive), with timeouts and exponential-backoff retries on 429/5xx.
+    Latency counters are kept so we can see where the time goes, and the outcome of
+    every response (including retried ones) is fed to the adaptive rate limiter.
+    Responses can be recorded to a file and replayed from it without a network (see
+    http_record.py).
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+=============================================================================
+"""
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import http_record
+import rate_limiter
+import metrics
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1
+DEFAULT_POOL_SIZE = 16
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class RequestStats:
+    """
+    Thread-safe latency counters. Request time is the wall-clock time of a call including
+    retries; connect time is the TCP (and TLS) setup time of each new connection. Both
+    are also recorded as metrics.py timers (http_request and http_connect).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.request_time = 0.0
+        self.max_request_time = 0.0
+        self.connections = 0
+        self.connect_time = 0.0
+        self.by_method = {}
+
+    def record_request(self, method, elapsed, error=False):
+        metrics.observe('http_request', elapsed)
+        metrics.count('http_requests')
+        if error:
+            metrics.count('http_errors')
+        with self.lock:
+            self.requests += 1
+            self.request_time += elapsed
+            self.max_request_time = max(self.max_request_time, elapsed)
+            self.by_method[method] = self.by_method.get(method, 0) + 1
+            if error:
+                self.errors += 1
+
+    def record_connect(self, elapsed):
+        metrics.observe('http_connect', elapsed)
+        with self.lock:
+            self.connections += 1
+            self.connect_time += elapsed
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'by_method': dict(self.by_method),
+                'request_time': round(self.request_time, 3),
+                'mean_request_time': round(self.request_time / self.requests, 3) if self.requests else 0,
+                'max_request_time': round(self.max_request_time, 3),
+                'connections': self.connections,
+                'connect_time': round(self.connect_time, 3),
+                'mean_connect_time': round(self.connect_time / self.connections, 3) if self.connections else 0,
+            }
+
+    def summary(self):
+        d = self.as_dict()
+        return (f"HTTP: {d['requests']} requests ({d['errors']} errors), "
+                f"{d['request_time']}s total, {d['mean_request_time']}s mean, "
+                f"{d['max_request_time']}s max; {d['connections']} connections opened, "
+                f"{d['connect_time']}s connecting ({d['mean_connect_time']}s mean)")
+
+
+stats = RequestStats()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            stats.record_connect(time.perf_counter() - start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            stats.record_connect(time.perf_counter() - start)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools time connection setup."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+class ObservedRetry(Retry):
+    """Retry that tells the rate limiter about responses that are retried, eg 429s."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None,
+                  _stacktrace=None):
+        if _pool is not None:
+            host_url = f'{_pool.scheme}://{_pool.host}'
+            if _pool.port and _pool.port not in (80, 443):
+                host_url += f':{_pool.port}'
+            rate_limiter.controller.feedback(
+                host_url, status=response.status if response else None,
+                retry_after=response.headers.get('Retry-After') if response else None,
+                error=error is not None)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def record_key(method, url, kwargs):
+    key = http_record.request_key(method, url, kwargs.get('params'))
+    # a HEAD following redirects (as in real_url()) has a different response to one that doesn't
+    return key if kwargs.get('allow_redirects', True) else key + ' (no redirects)'
+
+
+class HttpClient:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = timeout
+        retry = ObservedRetry(total=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=['HEAD', 'GET'],
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                   max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        recording = http_record.recording
+        if recording and recording.replay:
+            return self.replay(recording, method, url, **kwargs)
+
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            stats.record_request(method, time.perf_counter() - start, error=True)
+            rate_limiter.controller.feedback(url, error=True)
+            raise
+
+        elapsed = time.perf_counter() - start
+        stats.record_request(method, elapsed, error=response.status_code >= 400)
+        rate_limiter.controller.feedback(url, response.status_code, elapsed,
+                                         response.headers.get('Retry-After'))
+        if recording:
+            # reads the whole body, so a streamed response is then served from memory
+            recording.save(record_key(method, url, kwargs), response)
+        return response
+
+    def replay(self, recording, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = recording.load(record_key(method, url, kwargs))
+        except http_record.ReplayMissError:
+            stats.record_request(method, time.perf_counter() - start, error=True)
+            raise
+        stats.record_request(method, time.perf_counter() - start,
+                             error=response.status_code >= 400)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+client = None
+client_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Replace the shared client with one using the given HttpClient options."""
+    global client
+    with client_lock:
+        if client:
+            client.close()
+        client = HttpClient(**kwargs)
+    return client
+
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            client = HttpClient()
+        return client
+
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return get_client().head(url, **kwargs)
+
+
+def add_arguments(cmdline):
+    """Add the command line switches used to configure the shared client."""
+    cmdline.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                         help=f'HTTP timeout in seconds (default is {DEFAULT_TIMEOUT} seconds)')
+    cmdline.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                         help=f'Number of times to retry a request that fails or returns 429/5xx (default is {DEFAULT_RETRIES})')
+    cmdline.add_argument('--backoff', type=float, default=DEFAULT_BACKOFF,
+                         help=f'Backoff factor (in seconds) for exponential delay between retries (default is {DEFAULT_BACKOFF})')
+    cmdline.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                         help=f'Maximum number of keep-alive connections per host (default is {DEFAULT_POOL_SIZE})')
+    record = cmdline.add_mutually_exclusive_group()
+    record.add_argument('--record', metavar='FILE',
+                        help='Save every response in FILE (and FILE.idx) for --replay')
+    record.add_argument('--replay', metavar='FILE',
+                        help='Serve requests from responses saved with --record instead of the '
+                        'network; requests that weren\'t recorded fail')
+    return cmdline
+
+
+def configure_from_args(args):
+    if getattr(args, 'replay', None):
+        http_record.open_recording(args.replay, replay=True)
+        # nothing to be polite to
+        rate_limiter.controller.enabled = False
+    elif getattr(args, 'record', None):
+        http_record.open_recording(args.record)
+    return configure(timeout=args.timeout, retries=args.retries,
+                     backoff=args.backoff, pool_size=args.pool_size)
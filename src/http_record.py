@@ -0,0 +1,138 @@
+"""
+=============================================================================
+File: http_record.py
+Description: Record the responses to HTTP requests and replay them later without a
+    network, so that crawls can be repeated exactly and parsing and pipeline throughput
+    measured on their own.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+A recording is two files: <name> holds the response bodies back to back and <name>.idx
+has one JSON line per response giving the request (method and URL), the status, the
+final URL after redirects, a few headers, and the offset and length of the body in
+<name>. When replaying, the data file is memory-mapped, so a body is read straight from
+the page cache. A request that wasn't recorded fails with ReplayMissError.
+=============================================================================
+"""
+import json
+import mmap
+import os
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+
+INDEX_SUFFIX = '.idx'
+# Headers kept with each response; others aren't used by the scrapers
+KEPT_HEADERS = ['Content-Type', 'Content-Length', 'ETag', 'Last-Modified', 'Location',
+                'Retry-After']
+
+
+class ReplayMissError(requests.exceptions.ConnectionError):
+    """The request wasn't recorded."""
+
+
+def request_key(method, url, params=None):
+    """Return the key of a request: its method and full URL (including params)."""
+    if params:
+        url = requests.Request(method, url, params=params).prepare().url
+    return f'{method.upper()} {url}'
+
+
+class Recording:
+    def __init__(self, filename, replay=False):
+        """Open filename for replaying or, if replay is False, for recording (appending)."""
+        self.filename = filename
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self.load_index()
+
+        if replay:
+            self.fh = open(filename, 'rb')
+            size = os.fstat(self.fh.fileno()).st_size
+            self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            self.index_fh = None
+        else:
+            self.fh = open(filename, 'ab')
+            self.index_fh = open(filename + INDEX_SUFFIX, 'a')
+
+    def load_index(self):
+        index_filename = self.filename + INDEX_SUFFIX
+        if not os.path.isfile(index_filename):
+            if self.replay:
+                raise FileNotFoundError(f'No recording index {index_filename}')
+            return
+        with open(index_filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line is incomplete if we were killed while writing it
+                    break
+                # later recordings of a request replace earlier ones
+                self.index[entry['key']] = entry
+
+    def save(self, key, response):
+        """Record response, which must not be a streamed response still being read."""
+        body = response.content or b''
+        headers = {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers}
+        with self.lock:
+            self.fh.seek(0, os.SEEK_END)
+            offset = self.fh.tell()
+            self.fh.write(body)
+            self.fh.flush()
+            entry = {'key': key, 'status': response.status_code, 'url': response.url,
+                     'headers': headers, 'offset': offset, 'length': len(body)}
+            self.index[key] = entry
+            self.index_fh.write(json.dumps(entry) + '\n')
+            self.index_fh.flush()
+
+    def load(self, key):
+        """Return the recorded response for key as a requests.Response."""
+        entry = self.index.get(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                raise ReplayMissError(f'Not recorded: {key}')
+            self.hits += 1
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = bytes(self.data[entry['offset']:entry['offset'] + entry['length']])
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def close(self):
+        with self.lock:
+            if self.replay and self.data:
+                self.data.close()
+            self.fh.close()
+            if self.index_fh:
+                self.index_fh.close()
+
+    def summary(self):
+        if self.replay:
+            return f'Replay: {self.hits} responses replayed, {self.misses} not recorded'
+        return f'Record: {len(self.index)} responses in {self.filename}'
+
+
+recording = None
+
+
+def open_recording(filename, replay=False):
+    global recording
+    close_recording()
+    recording = Recording(filename, replay)
+    return recording
+
+
+def close_recording():
+    global recording
+    if recording:
+        recording.close()
+        recording = None
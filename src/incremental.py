@@ -0,0 +1,203 @@
+"""
+=============================================================================
+File: incremental.py
+Description: Support for incremental recrawls. For each page fetched we keep its ETag,
+    Last-Modified date, a hash of its content and the data scraped from it. On the next
+    run, pages are requested conditionally; if a page hasn't changed, the saved data is
+    reused without parsing the page. Only new or changed records need to be output.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+=============================================================================
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+DEFAULT_STATE_FILE = './page-state.sqlite'
+COMMIT_EVERY = 100
+# Seconds to wait for another process (eg a shard) that is writing to the state file
+BUSY_TIMEOUT = 60
+
+# Items are tagged with their status using this key. It's not in any HEADER so it's
+# never output.
+STATUS = '_status'
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class PageStore:
+    def __init__(self, filename=DEFAULT_STATE_FILE, commit_every=COMMIT_EVERY):
+        """
+        Saved records are committed every commit_every saves. Use 1 when several processes
+        share the file (eg --shards) so that none holds the write lock for long.
+        """
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.uncommitted = 0
+        self.commit_every = commit_every
+        self.counts = {NEW: 0, CHANGED: 0, UNCHANGED: 0}
+        self.conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        # readers don't block the writer (and vice versa)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, '
+                          'last_modified TEXT, hash TEXT, record TEXT, fetched REAL)')
+        self.conn.commit()
+
+    def row(self, url):
+        with self.lock:
+            return self.conn.execute('SELECT etag, last_modified, hash, record FROM pages '
+                                     'WHERE url = ?', (url,)).fetchone()
+
+    def headers(self, url):
+        """Return headers for a conditional request for url."""
+        headers = {}
+        row = self.row(url)
+        if row:
+            etag, last_modified = row[0], row[1]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def previous(self, url):
+        """Return the record saved for url or None."""
+        row = self.row(url)
+        return json.loads(row[3]) if row else None
+
+    def records(self):
+        """Return a list of the records saved for all pages."""
+        with self.lock:
+            return [json.loads(record) for record, in self.conn.execute('SELECT record FROM pages')]
+
+    def fetched_times(self):
+        """Return dict of url -> time (as time.time()) the page was last fetched, for all pages."""
+        with self.lock:
+            return dict(self.conn.execute('SELECT url, fetched FROM pages'))
+
+    def unchanged(self, url):
+        """Return the record saved for url, which is known to be unchanged."""
+        row = self.row(url)
+        with self.lock:
+            self.counts[UNCHANGED] += 1
+        return json.loads(row[3])
+
+    def check(self, url, response):
+        """
+        Return the saved record if the content of response is the same as when url was
+        last fetched; otherwise return None and remember the response's validators for
+        save().
+        """
+        row = self.row(url)
+        digest = content_hash(response.content)
+        if row and row[2] == digest:
+            return self.unchanged(url)
+
+        with self.lock:
+            self.pending[url] = (response.headers.get('ETag'),
+                                 response.headers.get('Last-Modified'), digest, row is not None)
+        return None
+
+    def save(self, url, record, keep=True):
+        """
+        Save the record scraped from url, which was fetched after check() returned None.
+        Return NEW or CHANGED. If keep is False (eg the record has an error), the record
+        isn't saved so the page will be parsed again next time.
+        """
+        with self.lock:
+            etag, last_modified, digest, existed = self.pending.pop(url, (None, None, None, False))
+            status = CHANGED if existed else NEW
+            self.counts[status] += 1
+            if keep and digest:
+                self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                                  (url, etag, last_modified, digest, json.dumps(record), time.time()))
+                self.uncommitted += 1
+                if self.uncommitted >= self.commit_every:
+                    self.conn.commit()
+                    self.uncommitted = 0
+        return status
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def summary(self):
+        return (f'Incremental: {self.counts[NEW]} new, {self.counts[CHANGED]} changed, '
+                f'{self.counts[UNCHANGED]} unchanged pages')
+
+
+class IncrementalWriter:
+    """
+    Wraps an OutputWriter so that only new and changed items are written. If delta_writer
+    is given, new and changed items are written to it instead and all items are written
+    to writer.
+    """
+
+    def __init__(self, writer, delta_writer=None):
+        self.writer = writer
+        self.delta_writer = delta_writer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, item):
+        changed = item.get(STATUS) != UNCHANGED
+        if self.delta_writer:
+            if changed:
+                self.delta_writer.write(item)
+            self.writer.write(item)
+        elif changed:
+            self.writer.write(item)
+
+    def as_csv(self, items):
+        for item in items:
+            self.write(item)
+
+    def flush(self):
+        self.writer.flush()
+        if self.delta_writer:
+            self.delta_writer.flush()
+
+    def checkpoint(self):
+        if self.delta_writer:
+            self.delta_writer.checkpoint()
+        return self.writer.checkpoint()
+
+    def close(self):
+        self.writer.close()
+        if self.delta_writer:
+            self.delta_writer.close()
+
+
+def strip_status(record):
+    return {k: v for k, v in record.items() if k != STATUS}
+
+
+def add_arguments(cmdline):
+    cmdline.add_argument('--incremental', action='store_true', default=False,
+                         help='Only parse pages that have changed since the last run and only '
+                         'output new or changed records (see --delta)')
+    cmdline.add_argument('--state-file', default=DEFAULT_STATE_FILE,
+                         help=f'With --incremental, file in which page state is kept between runs (default is {DEFAULT_STATE_FILE})')
+    cmdline.add_argument('--delta', dest='delta',
+                         help='With --incremental, write new or changed records to this file and '
+                         'all records to the --csv file')
+    return cmdline
+
+
+def open_store_from_args(args, shared=False):
+    """Open the store if --incremental; shared is True if other processes use it too."""
+    if not args.incremental:
+        return None
+    return PageStore(args.state_file, 1 if shared else COMMIT_EVERY)
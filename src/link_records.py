@@ -0,0 +1,278 @@
+"""
+=============================================================================
+File: link_records.py
+Description: Link The Collection's records (output of allcatsgrey_collection.py) to the
+    downloadable documents (output of allcatsgrey_documents.py and
+    allcatsgrey_downloads.py) and output the scored matches.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+Comparing every record with every document is too slow, so candidates are found using
+blocking keys and an inverted index:
+
+1. Blocking keys: a record and a document that share a key are linked with score 1. The
+   keys are the download file name, ISBN and normalised title.
+2. Otherwise, documents sharing any of the record's PROBE_WORDS rarest title words are
+   found from an inverted index of document title and file name words. Words that appear
+   in more than --max-df of the documents aren't indexed. The candidates with the highest
+   IDF-weighted word overlap are scored by combining the word overlap with the similarity of the
+   titles' character trigrams.
+=============================================================================
+"""
+
+import argparse
+import heapq
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlparse, unquote
+from utils import *
+import sinks
+
+DEFAULT_MIN_SCORE = 0.6
+DEFAULT_TOP = 1
+DEFAULT_MAX_DF = 0.01
+DEFAULT_CANDIDATES = 20
+# only the record's rarest words are looked up in the inverted index
+PROBE_WORDS = 3
+# weight of word overlap in the score; trigram similarity has the rest
+WORD_WEIGHT = 0.5
+HEADER = ['Index', 'Collection Title', 'Call Number', 'ISBN', 'Document Title', 'URL',
+          'Categories', 'Score', 'Method']
+SQLITE_TABLE = 'links'
+# a record can be linked to several documents
+SQLITE_KEY = ['Index', 'URL']
+
+# Methods
+FILENAME = 'filename'
+ISBN = 'isbn'
+TITLE = 'title'
+FUZZY = 'fuzzy'
+
+STOP_WORDS = set('a an and are as at be by for from in into is it of on or the their to '
+                 'with pdf doc docx final v1 v2'.split())
+ISBN_PATTERN = re.compile(r'\b(?:97[89][- ]?)?(?:\d[- ]?){9}[\dxX]\b')
+
+
+def words(text):
+    return [w for w in re.findall(r'[a-z0-9]+', (text or '').lower()) if w not in STOP_WORDS]
+
+
+def normalised_title(text):
+    return ' '.join(words(text))
+
+
+def trigrams(text):
+    text = f' {normalised_title(text)} '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def url_filename(url):
+    """Return the file name in url without its extension, eg 'Financial-Sustainability'."""
+    name = os.path.basename(unquote(urlparse(url or '').path))
+    return os.path.splitext(name)[0].lower()
+
+
+def isbns(text):
+    """Return the ISBNs in text, without hyphens or spaces."""
+    return {re.sub(r'[- ]', '', m).upper() for m in ISBN_PATTERN.findall(text or '')}
+
+
+def record_keys(record):
+    """Return the blocking keys of a collection record as (method, key) pairs."""
+    keys = set()
+    download = record.get('Download', '')
+    # Download is a local path or a URL if the file was found; otherwise it's a message
+    if download.startswith(('.', '/', 'http')):
+        name = url_filename(download)
+        if name:
+            keys.add((FILENAME, name))
+    keys.update((ISBN, isbn) for isbn in isbns(record.get('ISBN')))
+    title = normalised_title(record.get('Title'))
+    if title:
+        keys.add((TITLE, title))
+    return keys
+
+
+def document_keys(document):
+    keys = set()
+    name = url_filename(document.get('URL'))
+    if name:
+        keys.add((FILENAME, name))
+    keys.update((ISBN, isbn) for isbn in isbns(document.get('Title')) | isbns(name))
+    title = normalised_title(document.get('Title'))
+    if title:
+        keys.add((TITLE, title))
+    return keys
+
+
+class DocumentIndex:
+    def __init__(self, documents, max_df=DEFAULT_MAX_DF):
+        """
+        documents is a list of dicts with Title, URL and Categories. Words in more than
+        max_df (a fraction) of the documents aren't indexed.
+        """
+        self.documents = documents
+        self.keys = defaultdict(list)
+        postings = defaultdict(list)
+        self.words = []
+        self.trigrams = []
+        for i, document in enumerate(documents):
+            for key in document_keys(document):
+                self.keys[key].append(i)
+            document_words = set(words(f'{document.get("Title", "")} '
+                                       f'{url_filename(document.get("URL"))}'))
+            for word in document_words:
+                postings[word].append(i)
+            self.words.append(document_words)
+            self.trigrams.append(trigrams(document.get('Title')))
+
+        n = len(documents)
+        max_postings = max(1, int(max_df * n))
+        self.idf = {word: math.log(1 + n / len(docs)) for word, docs in postings.items()}
+        self.postings = {word: docs for word, docs in postings.items()
+                         if len(docs) <= max_postings}
+        self.weights = [sum(self.idf[w] for w in document_words)
+                        for document_words in self.words]
+
+    def exact_matches(self, record):
+        """Return {document number: method} for documents sharing a blocking key with record."""
+        matches = {}
+        # the order of preference for the method reported
+        for method in (FILENAME, ISBN, TITLE):
+            for key_method, key in record_keys(record):
+                if key_method == method:
+                    for i in self.keys.get((method, key), []):
+                        matches.setdefault(i, method)
+        return matches
+
+    def candidates(self, record_words, record_weight, min_word_score=0,
+                   limit=DEFAULT_CANDIDATES):
+        """
+        Return up to limit (document number, weighted word overlap) with the most overlap,
+        skipping documents whose word overlap with the record can't reach min_word_score.
+        """
+        probes = sorted((w for w in record_words if w in self.postings),
+                        key=self.idf.get, reverse=True)[:PROBE_WORDS]
+        found = set()
+        for word in probes:
+            found.update(self.postings[word])
+
+        if min_word_score > 0 and record_weight:
+            # the weighted Jaccard is at most the ratio of the smaller to the larger weight
+            low, high = record_weight * min_word_score, record_weight / min_word_score
+            found = [i for i in found if low <= self.weights[i] <= high]
+
+        # the overlap includes the common words that weren't looked up
+        overlap = ((i, sum(self.idf[w] for w in record_words & self.words[i])) for i in found)
+        return heapq.nlargest(limit, overlap, key=lambda o: o[1])
+
+    def score(self, record_weight, record_trigrams, i, overlap):
+        # weighted Jaccard of the words and Dice coefficient of the trigrams
+        union = record_weight + self.weights[i] - overlap
+        word_score = overlap / union if union else 0
+        document_trigrams = self.trigrams[i]
+        total = len(record_trigrams) + len(document_trigrams)
+        trigram_score = 2 * len(record_trigrams & document_trigrams) / total if total else 0
+        return WORD_WEIGHT * word_score + (1 - WORD_WEIGHT) * trigram_score
+
+    def match(self, record, top=DEFAULT_TOP, min_score=DEFAULT_MIN_SCORE,
+              candidates=DEFAULT_CANDIDATES):
+        """Return up to top (document number, score, method) for record, best first."""
+        exact = self.exact_matches(record)
+        if exact:
+            return [(i, 1.0, method) for i, method in exact.items()][:top]
+
+        record_words = set(words(record.get('Title')))
+        record_weight = sum(self.idf.get(w, 0) for w in record_words)
+        record_trigrams = trigrams(record.get('Title'))
+        # even with identical trigrams, a match needs this much word overlap
+        min_word_score = (min_score - (1 - WORD_WEIGHT)) / WORD_WEIGHT
+        scored = [(i, self.score(record_weight, record_trigrams, i, overlap), FUZZY)
+                  for i, overlap in self.candidates(record_words, record_weight,
+                                                    min_word_score, candidates)]
+        scored = [s for s in scored if s[1] >= min_score]
+        scored.sort(key=lambda s: s[1], reverse=True)
+        return scored[:top]
+
+
+def read_documents(filenames):
+    """Return the documents in filenames, keeping the first of any with the same URL."""
+    documents = {}
+    for filename in filenames:
+        for row in csv_to_dicts(filename):
+            url = row.get('URL')
+            if url and not row.get('Error') and url not in documents:
+                documents[url] = row
+    return list(documents.values())
+
+
+def link_records(records, index, writer, top=DEFAULT_TOP, min_score=DEFAULT_MIN_SCORE,
+                 candidates=DEFAULT_CANDIDATES):
+    counts = Counter()
+    for record in records:
+        matches = index.match(record, top, min_score, candidates)
+        counts[matches[0][2] if matches else 'unmatched'] += 1
+        for i, score, method in matches:
+            document = index.documents[i]
+            writer.write({'Index': record.get('Index'),
+                          'Collection Title': record.get('Title'),
+                          'Call Number': record.get('Call Number'),
+                          'ISBN': record.get('ISBN'),
+                          'Document Title': document.get('Title'),
+                          'URL': document.get('URL'),
+                          'Categories': document.get('Categories'),
+                          'Score': f'{score:.3f}',
+                          'Method': method})
+    return counts
+
+
+def setup_command_line():
+    """
+    Define command line switches
+    """
+    cmdline = argparse.ArgumentParser(prog='link_records.py')
+    cmdline.add_argument('--collection', required=True,
+                         help='CSV file output by allcatsgrey_collection.py')
+    cmdline.add_argument('--documents', required=True, nargs='+',
+                         help='CSV files output by allcatsgrey_documents.py and/or '
+                         'allcatsgrey_downloads.py')
+    cmdline.add_argument('--csv', dest='output',
+                         help='Filename of CSV file (tab-separated) for the matches. The file will '
+                         'be appended to if it exists (default output is to console)')
+    cmdline.add_argument('--min-score', type=float, default=DEFAULT_MIN_SCORE,
+                         help=f'Minimum score (0 to 1) of a fuzzy match (default is {DEFAULT_MIN_SCORE})')
+    cmdline.add_argument('--top', type=int, default=DEFAULT_TOP,
+                         help=f'Maximum number of matches output per record (default is {DEFAULT_TOP})')
+    cmdline.add_argument('--candidates', type=int, default=DEFAULT_CANDIDATES,
+                         help=f'Number of candidates scored per record (default is {DEFAULT_CANDIDATES})')
+    cmdline.add_argument('--max-df', type=float, default=DEFAULT_MAX_DF,
+                         help='Ignore title words in more than this fraction of the documents '
+                         f'(default is {DEFAULT_MAX_DF})')
+    sinks.add_arguments(cmdline)
+
+    return cmdline
+
+
+def main():
+    args = setup_command_line().parse_args()
+
+    start = time.perf_counter()
+    documents = read_documents(args.documents)
+    index = DocumentIndex(documents, args.max_df)
+    print(f'Indexed {len(documents)} documents in {time.perf_counter() - start:.1f}s')
+
+    with OutputWriter(HEADER, args.output,
+                      sinks=sinks.open_sinks(args, HEADER, SQLITE_TABLE, SQLITE_KEY)) as writer:
+        counts = link_records(csv_to_dicts(args.collection), index, writer, args.top,
+                              args.min_score, args.candidates)
+
+    print(f'Linked {sum(counts.values()) - counts["unmatched"]} of {sum(counts.values())} '
+          f'records in {time.perf_counter() - start:.1f}s: '
+          + ', '.join(f'{n} {method}' for method, n in counts.most_common()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+=============================================================================
+File: metrics.py
+Description: Timers and counters for the stages of a crawl (fetching, parsing, resolving
+    redirects, downloading, writing), a live progress line, and a summary at the end of
+    a run as JSON or in the Prometheus text format.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+Each timer is a histogram of how long the calls it times took, with fixed buckets as in
+Prometheus, so recording a call is a few additions. Use timed() to time a function (or
+coroutine or generator function) and count() for counters. The summary is written with
+--metrics <file>: Prometheus text if the file name ends in .prom, otherwise JSON.
+--progress shows the number of rows written, items/sec and the ETA on stderr while the
+crawl runs.
+=============================================================================
+"""
+import bisect
+import contextlib
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+
+# Upper bounds (in seconds) of the histogram buckets; the last bucket is unbounded
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+PROMETHEUS_PREFIX = 'allcatsrgrey_'
+PROMETHEUS_SUFFIX = '.prom'
+PROGRESS_INTERVAL = 1
+# The counter shown by the progress line; see utils.OutputWriter
+ROWS = 'rows_written'
+# Rows also written to a --delta file, which aren't counted again in ROWS
+DELTA_ROWS = 'delta_rows_written'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        # call with Registry.lock held
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate the q'th quantile by interpolating within its bucket."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': round(self.sum, 3),
+            'mean': round(self.sum / self.count, 4) if self.count else 0,
+            'p50': round(self.quantile(0.5), 4),
+            'p99': round(self.quantile(0.99), 4),
+            'max': round(self.max, 4),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.timers = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].observe(seconds)
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'elapsed': round(time.time() - self.started, 3),
+                'counters': dict(self.counters),
+                'timers': {name: timer.as_dict() for name, timer in sorted(self.timers.items())},
+            }
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def as_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric = f'{PROMETHEUS_PREFIX}{name}_total'
+                lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+            for name, timer in sorted(self.timers.items()):
+                metric = f'{PROMETHEUS_PREFIX}{name}_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ['+Inf'], timer.counts):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines += [f'{metric}_sum {timer.sum}', f'{metric}_count {timer.count}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return one line per timer: calls, total and mean time, p50 and p99."""
+        d = self.as_dict()
+        lines = [f'Metrics: {d["elapsed"]}s; ' +
+                 ', '.join(f'{name} {value}' for name, value in sorted(d['counters'].items()))]
+        for name, t in d['timers'].items():
+            lines.append(f'  {name}: {t["count"]} calls, {t["total"]}s total, {t["mean"]}s mean, '
+                         f'p50 {t["p50"]}s, p99 {t["p99"]}s, max {t["max"]}s')
+        return '\n'.join(lines)
+
+
+# Shared by all the code in a process
+registry = Registry()
+
+
+def count(name, n=1):
+    registry.count(name, n)
+
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Time the body of a with statement, including when it raises an exception."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorator that times each call of a function, coroutine function or generator
+    function as name. A generator is timed while it runs, not while its caller handles
+    the items it yields.
+    """
+    def decorate(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                elapsed = 0.0
+                generator = func(*args, **kwargs)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    generator.close()
+                    registry.observe(name, elapsed)
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class Progress:
+    """
+    Shows the rows written so far, items/sec and (if the total is known) the ETA on one
+    line of stderr, updated every interval seconds in a background thread.
+    """
+
+    def __init__(self, total=None, interval=PROGRESS_INTERVAL, stream=sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.initial = registry.counter(ROWS)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.show()
+
+    def line(self):
+        done = registry.counter(ROWS) - self.initial
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed else 0
+        line = f'{done}' + (f'/{self.total}' if self.total else '') + f' items, {rate:.2f} items/sec'
+        if self.total and rate:
+            remaining = max(self.total - done, 0)
+            line += ', ETA ' + time.strftime('%H:%M:%S', time.gmtime(remaining / rate))
+        requests = registry.counter('http_requests')
+        return line + f', {requests} requests'
+
+    def show(self):
+        self.stream.write('\r' + self.line() + '\x1b[K')
+        self.stream.flush()
+
+    def stop(self):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.show()
+            self.stream.write('\n')
+            self.thread = None
+
+
+progress = None
+
+
+def set_total(total):
+    """Set the number of items expected, for the progress line's ETA."""
+    if progress:
+        progress.total = total
+
+
+def start_progress(total=None):
+    global progress
+    stop_progress()
+    progress = Progress(total)
+    progress.start()
+
+
+def stop_progress():
+    global progress
+    if progress:
+        progress.stop()
+        progress = None
+
+
+def write_summary(filename):
+    """Write the metrics to filename: Prometheus text if it ends in .prom, otherwise JSON."""
+    text = (registry.as_prometheus() if filename.endswith(PROMETHEUS_SUFFIX)
+            else registry.as_json() + '\n')
+    with open(filename, 'w') as f:
+        f.write(text)
+
+
+def add_arguments(cmdline):
+    cmdline.add_argument('--metrics', metavar='FILE',
+                         help='Save timings and counters for the run in FILE: in the Prometheus '
+                         f'text format if FILE ends in {PROMETHEUS_SUFFIX}, otherwise as JSON')
+    cmdline.add_argument('--progress', action='store_true', default=False,
+                         help='Show the number of items written, items/sec and ETA on stderr '
+                         'during the run')
+    return cmdline
+
+
+def start_from_args(args):
+    if args.progress:
+        start_progress()
+
+
+def finish_from_args(args):
+    """Stop the progress line, print the timings and save them if --metrics was given."""
+    stop_progress()
+    print(registry.summary())
+    if args.metrics:
+        write_summary(args.metrics)
@@ -0,0 +1,124 @@
+"""
+=============================================================================
+File: pipeline.py
+Description: Run work through a chain of stages, each with its own worker threads,
+    connected by bounded queues. Items stream through: the first are output while later
+    ones are still being fetched, and memory use doesn't grow with the amount of work.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+The items produced by the source are passed to each stage's function in turn and the
+results are yielded in source order. At most max_in_flight items are between the source
+and the consumer at any time, so a slow stage (or consumer) holds back the source rather
+than letting items pile up.
+=============================================================================
+"""
+import queue
+import threading
+from collections import namedtuple
+import metrics
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_IN_FLIGHT = 8
+POLL_SECONDS = 0.1
+
+# func is called with each item and returns the item passed to the next stage
+Stage = namedtuple('Stage', ['name', 'func', 'workers'], defaults=[DEFAULT_WORKERS])
+
+# marks the end of the items in a queue
+DONE = object()
+
+
+class StageError:
+    """Wraps an exception raised by a stage so it's raised in the consumer."""
+
+    def __init__(self, stage, exception):
+        self.stage = stage
+        self.exception = exception
+
+
+def run_pipeline(source, stages, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """
+    Yield the result of passing each item from source (an iterable, which is read in its
+    own thread) through stages. If the consumer stops early, the threads are stopped.
+    """
+    stop = threading.Event()
+    in_flight = threading.Semaphore(max_in_flight)
+    queues = [queue.Queue(max_in_flight) for _ in range(len(stages) + 1)]
+
+    def put(q, entry):
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def feed():
+        try:
+            for seq, item in enumerate(source):
+                while not in_flight.acquire(timeout=POLL_SECONDS):
+                    if stop.is_set():
+                        return
+                if not put(queues[0], (seq, item)):
+                    return
+        except Exception as e:
+            put(queues[0], (-1, StageError('source', e)))
+        put(queues[0], DONE)
+
+    def work(stage, inbox, outbox, remaining, lock):
+        while not stop.is_set():
+            try:
+                entry = inbox.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if entry is DONE:
+                # pass DONE on to the other workers of this stage, then downstream once
+                # they have all finished
+                inbox.put(DONE)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    put(outbox, DONE)
+                return
+
+            seq, item = entry
+            if not isinstance(item, StageError):
+                try:
+                    with metrics.timer(f'stage_{stage.name}'):
+                        item = stage.func(item)
+                except Exception as e:
+                    item = StageError(stage.name, e)
+            if not put(outbox, (seq, item)):
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        workers = max(1, stage.workers)
+        remaining, lock = [workers], threading.Lock()
+        threads.extend(threading.Thread(target=work, daemon=True,
+                                        args=(stage, queues[i], queues[i + 1], remaining, lock))
+                       for _ in range(workers))
+    for thread in threads:
+        thread.start()
+
+    # results that finished before an earlier item, by sequence number
+    pending = {}
+    next_seq = 0
+    try:
+        while True:
+            entry = queues[-1].get()
+            if entry is DONE:
+                break
+            seq, item = entry
+            if isinstance(item, StageError):
+                raise item.exception
+            pending[seq] = item
+            while next_seq in pending:
+                yield pending.pop(next_seq)
+                next_seq += 1
+                in_flight.release()
+    finally:
+        stop.set()
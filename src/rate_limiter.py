@@ -0,0 +1,182 @@
+"""
+=============================================================================
+File: rate_limiter.py
+Description: Adaptive limit on the rate of requests to each host, shared by all the
+    scrapers in place of fixed pauses between pages.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+Each host has a token bucket that refills at the host's current rate. The rate adapts
+like TCP's AIMD: while responses are quick and successful it increases by INCREASE
+requests per second every second; when the host returns 429 or 5xx, a request fails or
+a response is much slower than usual, it's multiplied by DECREASE (at most once every
+DECREASE_HOLDOFF seconds). If a response has a Retry-After header, no requests are
+started for the host until then. Rates are requests per second and can be fractional.
+=============================================================================
+"""
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+DEFAULT_RATE = 1
+DEFAULT_MIN_RATE = 0.05
+DEFAULT_MAX_RATE = 5
+DEFAULT_BURST = 1
+INCREASE = 0.2
+DECREASE = 0.5
+DECREASE_HOLDOFF = 1
+# A response taking SLOW_FACTOR times the host's average response time is a sign of overload
+SLOW_FACTOR = 3
+LATENCY_SMOOTHING = 0.2
+OVERLOAD_STATUSES = [429, 500, 502, 503, 504]
+
+
+def retry_after_seconds(value):
+    """Return the delay in a Retry-After header (seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def host_of(url):
+    return urlparse(url).netloc if url else ''
+
+
+class HostRate:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.last_decrease = 0
+        self.latency = None
+        self.requests = 0
+        self.overloads = 0
+
+
+class RateController:
+    def __init__(self, rate=DEFAULT_RATE, min_rate=DEFAULT_MIN_RATE, max_rate=DEFAULT_MAX_RATE,
+                 burst=DEFAULT_BURST):
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # False when requests aren't sent to a real site, eg when replaying a recording
+        self.enabled = True
+        self.configure(rate, min_rate, max_rate, burst)
+
+    def configure(self, rate=None, min_rate=None, max_rate=None, burst=None):
+        """Change the settings; hosts start again at the (new) initial rate."""
+        with self.lock:
+            if min_rate is not None:
+                self.min_rate = min_rate
+            if max_rate is not None:
+                self.max_rate = max_rate
+            if burst is not None:
+                self.burst = burst
+            if rate is not None:
+                self.rate = rate
+            self.rate = min(self.max_rate, max(self.min_rate, self.rate))
+            self.hosts = {}
+
+    def host(self, url):
+        # call with self.lock held
+        host = host_of(url)
+        if host not in self.hosts:
+            self.hosts[host] = HostRate(self.rate, self.burst)
+        return self.hosts[host]
+
+    def reserve(self, url):
+        """
+        Take a turn to request url and return how long (in seconds) to wait before
+        starting the request.
+        """
+        if not self.enabled:
+            return 0
+        with self.lock:
+            state = self.host(url)
+            now = time.monotonic()
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * state.rate)
+            state.updated = now
+            state.tokens -= 1
+            state.requests += 1
+            delay = -state.tokens / state.rate if state.tokens < 0 else 0
+            return max(delay, state.blocked_until - now)
+
+    def wait(self, url):
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    def decrease(self, state, now):
+        # call with self.lock held
+        state.overloads += 1
+        if now - state.last_decrease >= DECREASE_HOLDOFF:
+            state.rate = max(self.min_rate, state.rate * DECREASE)
+            state.last_decrease = now
+
+    def feedback(self, url, status=None, elapsed=None, retry_after=None, error=False):
+        """Adapt the rate for url's host to the outcome of a request."""
+        if not self.enabled:
+            return
+        delay = retry_after_seconds(retry_after)
+        with self.lock:
+            state = self.host(url)
+            now = time.monotonic()
+            if delay:
+                state.blocked_until = max(state.blocked_until, now + delay)
+
+            slow = (elapsed is not None and state.latency is not None
+                    and elapsed > SLOW_FACTOR * state.latency)
+            if error or status in OVERLOAD_STATUSES or slow:
+                self.decrease(state, now)
+            elif state.rate < self.max_rate:
+                # grow by INCREASE per second, ie INCREASE / rate per request
+                state.rate = min(self.max_rate, state.rate + INCREASE / state.rate)
+
+            if elapsed is not None and not error:
+                state.latency = (elapsed if state.latency is None else
+                                 (1 - LATENCY_SMOOTHING) * state.latency
+                                 + LATENCY_SMOOTHING * elapsed)
+
+    def summary(self):
+        with self.lock:
+            if not self.hosts:
+                return 'Rate: no requests'
+            return '\n'.join(f'Rate {host}: {state.rate:.2f} req/s now, {state.requests} '
+                             f'requests, {state.overloads} overloaded responses'
+                             for host, state in self.hosts.items())
+
+
+# Shared by all the requests made by the scrapers
+controller = RateController()
+
+
+def configure(rate=None, min_rate=None, max_rate=None, burst=None):
+    controller.configure(rate, min_rate, max_rate, burst)
+
+
+def add_arguments(cmdline):
+    cmdline.add_argument('--max-rate', type=float, default=DEFAULT_MAX_RATE,
+                         help='Maximum requests per second to a host; the rate adapts up to this '
+                         f'while the site responds quickly (default is {DEFAULT_MAX_RATE})')
+    cmdline.add_argument('--min-rate', type=float, default=DEFAULT_MIN_RATE,
+                         help='Minimum requests per second to a host when the site is overloaded '
+                         f'(default is {DEFAULT_MIN_RATE})')
+    return cmdline
+
+
+def configure_from_args(args, interval=None, rate=None):
+    """
+    Set the initial rate to rate, or one request every interval seconds (eg --sleep). If
+    interval is 0, start at the maximum rate. If both are None, keep the current rate.
+    """
+    if rate is None and interval is not None:
+        rate = 1 / interval if interval > 0 else args.max_rate
+    configure(rate, args.min_rate, args.max_rate)
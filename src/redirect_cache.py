@@ -0,0 +1,168 @@
+"""
+=============================================================================
+File: redirect_cache.py
+Description: Persistent cache of resolved redirects (raw URL -> final URL) so that
+    re-running a crawl doesn't repeat thousands of HEAD requests. Entries expire after a
+    time-to-live and the least recently used entries are evicted when the cache is full.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+=============================================================================
+"""
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_FILE = './redirect-cache.sqlite'
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_ENTRIES = 250000
+DEFAULT_RESOLVE_WORKERS = 4
+SECONDS_PER_DAY = 24 * 60 * 60
+COMMIT_EVERY = 100
+
+
+class RedirectCache:
+    def __init__(self, filename=DEFAULT_CACHE_FILE, ttl_days=DEFAULT_TTL_DAYS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS redirects '
+                          '(url TEXT PRIMARY KEY, resolved TEXT, created REAL, last_used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS redirects_last_used ON redirects (last_used)')
+        self.conn.commit()
+
+    def get(self, url):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT resolved, created FROM redirects WHERE url = ?',
+                                    (url,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                self.conn.execute('UPDATE redirects SET last_used = ? WHERE url = ?', (now, url))
+                self.hits += 1
+                return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, url, resolved):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO redirects VALUES (?, ?, ?, ?)',
+                              (url, resolved, now, now))
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def evict(self):
+        """Remove expired entries then, if the cache is still too big, the least recently used."""
+        with self.lock:
+            self.conn.execute('DELETE FROM redirects WHERE created < ?',
+                              (time.time() - self.ttl,))
+            count = self.conn.execute('SELECT COUNT(*) FROM redirects').fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute('DELETE FROM redirects WHERE url IN '
+                                  '(SELECT url FROM redirects ORDER BY last_used LIMIT ?)',
+                                  (count - self.max_entries,))
+            self.conn.commit()
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.conn.close()
+
+    def resolve(self, url, resolver):
+        resolved = self.get(url)
+        if resolved is None:
+            resolved = resolver(url)
+            self.put(url, resolved)
+        return resolved
+
+    def resolve_many(self, urls, resolver, workers=DEFAULT_RESOLVE_WORKERS):
+        """
+        Return dict of url -> resolved URL. URLs not in the cache are resolved concurrently.
+        If resolving a URL fails, its value is the exception raised.
+        """
+        result = {}
+        unresolved = []
+        for url in dict.fromkeys(urls):
+            resolved = self.get(url)
+            if resolved is None:
+                unresolved.append(url)
+            else:
+                result[url] = resolved
+
+        result.update(resolve_many(unresolved, resolver, workers))
+        for url in unresolved:
+            if not isinstance(result[url], Exception):
+                self.put(url, result[url])
+        self.commit()
+
+        return result
+
+    def summary(self):
+        return f'Redirect cache: {self.hits} hits, {self.misses} misses'
+
+
+def resolve_many(urls, resolver, workers=DEFAULT_RESOLVE_WORKERS):
+    """Resolve urls concurrently without a cache; see RedirectCache.resolve_many()."""
+
+    def resolve(url):
+        try:
+            return resolver(url)
+        except Exception as e:
+            return e
+
+    urls = list(dict.fromkeys(urls))
+    if len(urls) <= 1 or workers <= 1:
+        return {url: resolve(url) for url in urls}
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        return dict(zip(urls, executor.map(resolve, urls)))
+
+
+# The cache used by utils.real_url(); None if caching is off. See open_cache().
+cache = None
+
+
+def open_cache(filename=DEFAULT_CACHE_FILE, ttl_days=DEFAULT_TTL_DAYS,
+               max_entries=DEFAULT_MAX_ENTRIES):
+    global cache
+    cache = RedirectCache(filename, ttl_days, max_entries)
+    return cache
+
+
+def close_cache():
+    global cache
+    if cache:
+        print(cache.summary())
+        cache.close()
+        cache = None
+
+
+def add_arguments(cmdline):
+    cmdline.add_argument('--redirect-cache', default=DEFAULT_CACHE_FILE,
+                         help=f'File used to cache resolved redirects between runs (default is {DEFAULT_CACHE_FILE})')
+    cmdline.add_argument('--no-redirect-cache', action='store_true', default=False,
+                         help='Always resolve redirects (do not use a redirect cache)')
+    cmdline.add_argument('--redirect-cache-days', type=float, default=DEFAULT_TTL_DAYS,
+                         help=f'Days for which a resolved redirect is cached (default is {DEFAULT_TTL_DAYS})')
+    cmdline.add_argument('--resolve-workers', type=int, default=DEFAULT_RESOLVE_WORKERS,
+                         help=f'Number of redirects to resolve at the same time (default is {DEFAULT_RESOLVE_WORKERS})')
+    return cmdline
+
+
+def open_cache_from_args(args):
+    if not args.no_redirect_cache:
+        return open_cache(args.redirect_cache, args.redirect_cache_days)
+    return None
@@ -0,0 +1,156 @@
+"""
+=============================================================================
+File: sinks.py
+Description: Extra outputs for OutputWriter so that scraped data can be loaded and joined
+    without re-parsing CSV files: Parquet (typed columns, written in row groups) and an
+    indexed SQLite table. Both use the same HEADER as the CSV output.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+Parquet output requires pyarrow (pip install pyarrow). A Parquet file can't be appended
+to, so it's written afresh on each run and can't be used when resuming one. SQLite rows
+are keyed by Index if the HEADER has it, otherwise by URL (or by the key a script gives),
+so re-written rows replace earlier ones.
+=============================================================================
+"""
+import sqlite3
+
+DEFAULT_ROW_GROUP_SIZE = 10000
+INTEGER_COLUMNS = ['Index']
+
+
+def column_name(field):
+    """Return a SQL-friendly column name, eg 'Call Number' -> 'call_number'."""
+    return field.lower().replace(' ', '_')
+
+
+def quoted(name):
+    # some column names, eg index, are SQL keywords
+    return f'"{name}"'
+
+
+def typed_value(field, value):
+    if field in INTEGER_COLUMNS:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    return '' if value is None else str(value)
+
+
+def default_key(header):
+    for field in ('Index', 'URL'):
+        if field in header:
+            return [field]
+    return []
+
+
+def key_index_name(table, key):
+    # Index and URL keys keep the names used before keys could be chosen
+    if key == ['Index']:
+        return f'{table}_index'
+    return f'{table}_{"_".join(column_name(field) for field in key)}_key'
+
+
+class ParquetSink:
+    def __init__(self, header, filename, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.header = header
+        self.row_group_size = row_group_size
+        self.schema = pa.schema([(column_name(field),
+                                  pa.int64() if field in INTEGER_COLUMNS else pa.string())
+                                 for field in header])
+        self.writer = pq.ParquetWriter(filename, self.schema)
+        self.rows = []
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+        while len(self.rows) >= self.row_group_size:
+            self.write_row_group(self.rows[:self.row_group_size])
+            self.rows = self.rows[self.row_group_size:]
+
+    def write_row_group(self, rows):
+        if not rows:
+            return
+        columns = [[typed_value(field, row[i]) for row in rows]
+                   for i, field in enumerate(self.header)]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema),
+                                row_group_size=self.row_group_size)
+
+    def close(self):
+        self.write_row_group(self.rows)
+        self.rows = []
+        self.writer.close()
+
+
+class SQLiteSink:
+    def __init__(self, header, filename, table, key=None):
+        """
+        key is the list of fields that identify a row; re-written rows replace earlier ones
+        with the same key. By default it's Index if the header has it, otherwise URL.
+        """
+        self.header = header
+        self.table = table
+        self.key = key or default_key(header)
+        self.conn = sqlite3.connect(filename)
+        columns = [f'{quoted(column_name(field))} '
+                   f'{"INTEGER" if field in INTEGER_COLUMNS else "TEXT"}' for field in header]
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(columns)})')
+        if self.key:
+            self.create_key()
+        if 'URL' in header and self.key[:1] != ['URL']:
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_url '
+                              f'ON {table} ({quoted(column_name("URL"))})')
+        self.insert = (f'INSERT OR REPLACE INTO {table} VALUES '
+                       f'({", ".join("?" * len(header))})')
+        self.conn.commit()
+
+    def create_key(self):
+        name = key_index_name(self.table, self.key)
+        indexes = self.conn.execute(f'PRAGMA index_list({self.table})').fetchall()
+        if any(index[1] == name for index in indexes):
+            return
+        # the table was written with another key (or none): drop it and keep the latest
+        # of the rows that have the same key
+        for index in indexes:
+            if index[2] and index[3] == 'c':
+                self.conn.execute(f'DROP INDEX {quoted(index[1])}')
+        columns = ', '.join(quoted(column_name(field)) for field in self.key)
+        self.conn.execute(f'DELETE FROM {self.table} WHERE rowid NOT IN '
+                          f'(SELECT MAX(rowid) FROM {self.table} GROUP BY {columns})')
+        self.conn.execute(f'CREATE UNIQUE INDEX {name} ON {self.table} ({columns})')
+
+    def write_rows(self, rows):
+        self.conn.executemany(self.insert,
+                              [[typed_value(field, row[i]) for i, field in enumerate(self.header)]
+                               for row in rows])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def add_arguments(cmdline):
+    cmdline.add_argument('--parquet',
+                         help='Also write the output to this Parquet file (requires pyarrow)')
+    cmdline.add_argument('--sqlite',
+                         help='Also write the output to a table in this SQLite database')
+    cmdline.add_argument('--table',
+                         help='Name of the SQLite table (default depends on the script)')
+    return cmdline
+
+
+def open_sinks(args, header, table, key=None):
+    """
+    Return the sinks requested on the command line; table is the default table name and
+    key the fields that identify a row in it (see SQLiteSink).
+    """
+    sinks = []
+    if args.parquet:
+        sinks.append(ParquetSink(header, args.parquet))
+    if args.sqlite:
+        sinks.append(SQLiteSink(header, args.sqlite, args.table or table, key))
+    return sinks
@@ -0,0 +1,130 @@
+"""
+=============================================================================
+File: treeview_crawler.py
+Description: Walk the downloads treeview without a browser by requesting each folder's
+    children from the AJAX endpoint that the treeview itself calls.
+Author: Praful https://github.com/Praful/allcatsrgrey
+Licence: GPL v3
+
+The treeview is WP-Filebase's file browser, which uses the jQuery treeview "async"
+plugin. When a folder is opened, the plugin requests the folder's children, passing the
+folder's id (eg wpfb-cat-12, or "source" for the top level) as root. The response is a
+JSON list of nodes, each with an id (wpfb-cat-N for folders, wpfb-file-N for files),
+HTML text holding a link, and hasChildren. Folders are requested concurrently.
+=============================================================================
+"""
+
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import *
+import http_client
+import metrics
+
+DEFAULT_AJAX_URL = 'https://allcatsrgrey.org.uk/wp/wp-admin/admin-ajax.php?action=wpfilebase'
+DEFAULT_WORKERS = 8
+ROOT = 'source'
+FOLDER_PREFIX = 'wpfb-cat-'
+FILE_PREFIX = 'wpfb-file-'
+SOURCE = 'downloads'
+
+
+def tree_params(root):
+    """Return the query parameters the treeview sends to list the children of root."""
+    return {'wpfb_action': 'tree', 'type': 'browser', 'base': 0, 'root': root}
+
+
+def node_link(node):
+    """Return (title, href) of the link in a treeview node's HTML text."""
+    soup = make_soup(node.get('text') or '')
+    link = soup.find('a')
+    if link is None:
+        return soup.get_text().strip(), None
+    return link.get_text().strip(), link.get('href')
+
+
+class TreeviewCrawler:
+    def __init__(self, writer, ajax_url=DEFAULT_AJAX_URL, workers=DEFAULT_WORKERS, seen=None):
+        """seen, if given, is a dedup.DedupIndex used to skip files already found."""
+        self.writer = writer
+        self.ajax_url = ajax_url
+        self.workers = workers
+        self.seen = seen
+        self.lock = threading.Lock()
+        # ids of the files and folders written or visited
+        self.emitted = set()
+        self.folders = 0
+        self.errors = 0
+
+    def children(self, root):
+        with host_limiter.limit(self.ajax_url):
+            response = http_client.get(self.ajax_url, params=tree_params(root))
+        response.raise_for_status()
+        return response.json()
+
+    def first_visit(self, node_id):
+        with self.lock:
+            if node_id in self.emitted:
+                return False
+            self.emitted.add(node_id)
+            return True
+
+    def write_file(self, title, url, categories, held):
+        """Write a file's row; its dedup entries are added to held. See save_held()."""
+        if self.seen:
+            if self.seen.seen(SOURCE, [url], title):
+                return
+            held.extend(self.seen.hold(SOURCE, [url], title))
+        self.writer.write({'Title': title, 'Categories': categories, 'URL': url})
+
+    def save_held(self, held):
+        if held:
+            # only once the rows are on disk, so that a file isn't skipped for good if its
+            # row is lost
+            self.writer.flush()
+            self.seen.save(held)
+
+    @metrics.timed('scrape_folder')
+    def scrape_folder(self, root, categories=None):
+        """Write the files in folder root and return [(id, categories)] for its subfolders."""
+        try:
+            nodes = self.children(root)
+        except Exception as e:
+            print('Error fetching folder', root, e)
+            traceback.print_exc()
+            with self.lock:
+                self.errors += 1
+            self.writer.write({'Categories': categories, 'URL': root, 'Error': repr(e)})
+            return []
+
+        subfolders = []
+        held = []
+        for node in nodes:
+            node_id = str(node.get('id', ''))
+            if not self.first_visit(node_id):
+                continue
+            title, href = node_link(node)
+            if node_id.startswith(FILE_PREFIX) and href:
+                print(node_id, href, title)
+                self.write_file(title, href, categories, held)
+            elif node_id.startswith(FOLDER_PREFIX):
+                subfolders.append((node_id, '#'.join((categories, title)) if categories else title))
+        self.save_held(held)
+
+        with self.lock:
+            self.folders += 1
+        return subfolders
+
+    def crawl(self, root=ROOT):
+        """Walk the tree below root, requesting up to self.workers folders at a time."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self.scrape_folder, root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for node_id, categories in future.result():
+                        print('============ Processing node', node_id)
+                        pending.add(executor.submit(self.scrape_folder, node_id, categories))
+
+    def summary(self):
+        return f'Treeview: {self.folders} folders read, {self.errors} failed'
@@ -14,10 +14,28 @@ import csv
 import contextlib
 import io
 import re
-import requests
+import http_client
+import redirect_cache
+import downloader
+import rate_limiter
+import metrics
+import threading
+import time
+import importlib
+import heapq
+from collections import namedtuple
+from urllib.parse import urlparse
 
 TAB = '\t'
 NEW_TAB_INDICATOR = '#new_tab'
+# Statuses of a HEAD request that may only mean the server rejects HEAD; see resolve_url()
+HEAD_REJECTED_STATUSES = [403, 405, 501]
+PARSERS = ['html.parser', 'lxml', 'selectolax']
+# Module make_soup() imports for a parser, if it isn't the parser's name
+PARSER_MODULES = {'selectolax': 'selectolax.lexbor'}
+DEFAULT_PARSER = 'html.parser'
+DEFAULT_FLUSH_ROWS = 100
+DEFAULT_FLUSH_SECONDS = 5
 
 def file_to_array(filename, strip=False):
     """ return list of strings, one line per list entry"""
@@ -31,6 +49,13 @@ def file_to_array(filename, strip=False):
 
     return result
 
+def csv_to_dicts(filename, delim=TAB):
+    """Yield the rows of a CSV file written by OutputWriter as dicts keyed by its header."""
+    # descriptions can be long
+    csv.field_size_limit(sys.maxsize)
+    with open(filename, newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f, delimiter=delim)
+
 def array_to_file(filename, array):
     with open(filename, 'w') as f:
         for item in array:
@@ -76,11 +101,35 @@ def smart_open(filename=None, filemode='w'):
 
 
 class OutputWriter:
-    def __init__(self, header, filename=None, delim=TAB):
+    """
+    Writes items as rows of a CSV file, or to the console if there's no filename. The file
+    is opened once, when the first row is written, and rows are buffered. The buffer is
+    written out when it holds flush_rows rows or flush_seconds have passed since it was
+    last written, and by flush(), checkpoint() and close(). Use as a context manager to
+    make sure all rows are written. Rows are also passed to any sinks (see sinks.py).
+    """
+
+    def __init__(self, header, filename=None, delim=TAB, flush_rows=DEFAULT_FLUSH_ROWS,
+                 flush_seconds=DEFAULT_FLUSH_SECONDS, sinks=None, counter=metrics.ROWS):
+        """counter is the metrics counter of the rows written."""
         self.header = header
-        self.filename = filename
+        self.counter = counter
+        self.sinks = sinks or []
+        self.filename = filename if filename != '-' else None
         self.delim = delim
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fh = None
+        self.writer = None
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def as_row(self, item):
         """
@@ -97,28 +146,232 @@ class OutputWriter:
         """
         return self.header
 
+    def open(self):
+        if self.fh:
+            return
+
+        if self.filename:
+            header_required = (not os.path.isfile(self.filename)
+                               or os.path.getsize(self.filename) == 0)
+            self.fh = io.open(self.filename, newline='', mode='a', encoding="utf-8")
+        else:
+            header_required = False
+            self.fh = sys.stdout
+
+        #  writer = csv.writer(output, delimiter=self.delim, lineterminator='\r\n')
+        self.writer = csv.writer(self.fh, delimiter=self.delim, lineterminator='\n')
+        if header_required:
+            self.writer.writerow(self.csv_header())
+
+    def write(self, item):
+        metrics.count(self.counter)
+        with self.lock:
+            self.buffer.append(self.as_row(item))
+            if (len(self.buffer) >= self.flush_rows
+                    or time.monotonic() - self.last_flush >= self.flush_seconds):
+                self.write_buffer()
+
+    @metrics.timed('write_csv')
     def as_csv(self, items):
         """
         Create a CSV of episodes scraped
         """
+        for item in items:
+            self.write(item)
+
+    @metrics.timed('csv_flush')
+    def write_buffer(self):
+        self.open()
+        self.writer.writerows(self.buffer)
+        for sink in self.sinks:
+            sink.write_rows(self.buffer)
+        self.buffer = []
+        self.fh.flush()
+        self.last_flush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.write_buffer()
+
+    def checkpoint(self):
+        """
+        Write all buffered rows to disk (fsync) and return the size of the output file,
+        ie the offset at which the next row will be written; None if output is to the
+        console.
+        """
+        with self.lock:
+            self.write_buffer()
+            if self.fh is sys.stdout:
+                return None
+            os.fsync(self.fh.fileno())
+            return os.fstat(self.fh.fileno()).st_size
+
+    def close(self):
+        with self.lock:
+            if self.buffer or (self.fh is None and self.filename):
+                self.write_buffer()
+            if self.fh and self.fh is not sys.stdout:
+                self.fh.close()
+            self.fh = None
+            for sink in self.sinks:
+                sink.close()
+            self.sinks = []
+
+
+def merge_csv_files(filenames, output_filename, key, delim=TAB, sinks=None):
+    """
+    Merge CSV files, each with a header row and sorted by the integer column key, into
+    output_filename in key order. The output file is appended to if it exists; the header
+    is only written if it's new. The merged rows are also written to any sinks, which are
+    then closed.
+    """
+    sinks = sinks or []
+    handles = [open(f, newline='', encoding='utf-8') for f in filenames if os.path.isfile(f)]
+    try:
+        readers = [csv.reader(fh, delimiter=delim) for fh in handles]
+        header = None
+        for reader in readers:
+            header = next(reader, None) or header
+        if header is None:
+            return
+
+        column = header.index(key)
+
+        def sort_key(row):
+            try:
+                return int(row[column])
+            except (ValueError, IndexError):
+                return 0
+
+        header_required = not os.path.isfile(output_filename) or os.path.getsize(output_filename) == 0
+        with smart_open(output_filename, 'a') as output:
+            writer = csv.writer(output, delimiter=delim, lineterminator='\n')
+            if header_required:
+                writer.writerow(header)
+            rows = []
+            for row in heapq.merge(*readers, key=sort_key):
+                writer.writerow(row)
+                if sinks:
+                    rows.append(row)
+                    if len(rows) >= DEFAULT_FLUSH_ROWS:
+                        for sink in sinks:
+                            sink.write_rows(rows)
+                        rows = []
+            for sink in sinks:
+                sink.write_rows(rows)
+    finally:
+        for fh in handles:
+            fh.close()
+        for sink in sinks:
+            sink.close()
+
 
-        header_rquired = False if not self.filename or (
-            self.filename and os.path.isfile(self.filename)) else True
-        with smart_open(self.filename, 'a') as output:
-            #  writer = csv.writer(output, delimiter=self.delim, lineterminator='\r\n')
-            writer = csv.writer(output, delimiter=self.delim, lineterminator='\n')
-            if header_rquired:
-                writer.writerow(self.csv_header())
+def compact_csv_file(filename, key, delim=TAB):
+    """
+    Rewrite filename (a CSV file with a header row) keeping only the last row for each
+    value of the column key, eg after failed rows have been fetched again and appended.
+    Rows with no key are kept. Return the number of rows removed.
+    """
+    with open(filename, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=delim)
+        column = next(reader).index(key)
+        last = {row[column]: i for i, row in enumerate(reader) if len(row) > column and row[column]}
+
+    removed = 0
+    temp_filename = filename + '.tmp'
+    with open(filename, newline='', encoding='utf-8') as f, \
+            open(temp_filename, 'w', newline='', encoding='utf-8') as output:
+        reader = csv.reader(f, delimiter=delim)
+        writer = csv.writer(output, delimiter=delim, lineterminator='\n')
+        writer.writerow(next(reader))
+        for i, row in enumerate(reader):
+            value = row[column] if len(row) > column else ''
+            if value and last[value] != i:
+                removed += 1
+            else:
+                writer.writerow(row)
+    os.replace(temp_filename, filename)
+    return removed
 
-            for item in items:
-                writer.writerow(self.as_row(item))
 
+class HostLimiter:
+    """
+    Politeness limits per host: at most max_concurrent requests in flight to a host and,
+    if pace is True, requests started no faster than rate_limiter allows.
+    """
 
+    def __init__(self, max_concurrent=2, pace=True):
+        self.max_concurrent = max_concurrent
+        self.pace = pace
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def configure(self, max_concurrent, pace=True):
+        with self.lock:
+            self.max_concurrent = max_concurrent
+            self.pace = pace
+            self.semaphores = {}
+
+    def semaphore(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_concurrent)
+            return self.semaphores[host]
+
+    @contextlib.contextmanager
+    def limit(self, url):
+        host = urlparse(url).netloc
+        start = time.perf_counter()
+        with self.semaphore(host):
+            if self.pace:
+                rate_limiter.controller.wait(url)
+            metrics.observe('host_wait', time.perf_counter() - start)
+            yield
+
+
+# Shared by all requests made by the scrapers; see set_host_limits()
+host_limiter = HostLimiter()
+
+def set_host_limits(max_concurrent, pace=True):
+    """
+    Allow max_concurrent requests to a host at a time. If pace is False, the caller paces
+    requests itself (eg using AsyncCrawler).
+    """
+    host_limiter.configure(max_concurrent, pace)
 
 
+@metrics.timed('resolve_url')
+def resolve_url(url):
+    """
+    Return the URL that url redirects to, without using the redirect cache. Raise
+    requests.HTTPError if that URL returns an error status, so that it isn't cached. If
+    the server doesn't allow HEAD requests, a GET is made instead, without reading the
+    body.
+    """
+    with host_limiter.limit(url):
+        response = http_client.head(url, allow_redirects=True)
+    if response.status_code in HEAD_REJECTED_STATUSES:
+        with host_limiter.limit(url):
+            with http_client.get(url, allow_redirects=True, stream=True) as response:
+                pass
+    response.raise_for_status()
+    return clean_url(response.url)
+
+@metrics.timed('real_url')
 def real_url(url):
-    result = requests.head(url, allow_redirects=True).url
-    return clean_url(result)
+    if redirect_cache.cache:
+        return redirect_cache.cache.resolve(url, resolve_url)
+    return resolve_url(url)
+
+@metrics.timed('real_urls')
+def real_urls(urls, workers=redirect_cache.DEFAULT_RESOLVE_WORKERS):
+    """
+    Batch version of real_url(). Return dict of url -> resolved URL, or the exception raised
+    if the URL couldn't be resolved.
+    """
+    if redirect_cache.cache:
+        return redirect_cache.cache.resolve_many(urls, resolve_url, workers)
+    return redirect_cache.resolve_many(urls, resolve_url, workers)
 
 def clean_url(url):
     if url:
@@ -128,41 +381,115 @@ def clean_url(url):
         return result
     return ''
 
+@metrics.timed('download_file')
 def download_file(url, folder):
-    try:
-        if url:
-            #  os.system('wget --append-output=wget-output.log --no-verbose --directory-prefix=docs %s' % url_clean)
-            #  -x mirrors the directory structure of the download
-            os.system('wget -x -N --no-verbose --directory-prefix=%s %s' %
-                      (folder, url))
-
-            doc_name = url.rsplit('/', 1)[-1]
-            file = os.path.join('.', folder, doc_name)
-            if os.path.isfile(file):
-                return file
-            else:
-                return f'Warning: file not downloaded: {url_clean}'
-        else:
-            return 'Warning: Blank URL provided'
-    except Exception as e:
-        return f'Error downloading {url}: {e}'
+    """
+    Download url into folder, mirroring the URL's directory structure (like wget -x -N).
+    Return the path of the file or a warning/error message.
+    """
+    if not url:
+        return 'Warning: Blank URL provided'
+
+    result = downloader.get_downloader(folder, host_limiter).download(url)
+    if result.status == downloader.FAILED:
+        return f'Error downloading {url}: {result.error}'
+    return result.path
+
+@metrics.timed('download_files')
+def download_files(urls, folder):
+    """
+    Download urls concurrently into folder; see download_file(). Return list of
+    downloader.DownloadResult in the same order as urls.
+    """
+    return downloader.get_downloader(folder, host_limiter).download_many(urls)
+
 
-#  r = requests.get(url, allow_redirects=True)  # to get content after redirection
-#  pdf_url = r.url # 'https://media.readthedocs.org/pdf/django/latest/django.pdf'
-#  with open('file_name.pdf', 'wb') as f:
-    #  f.write(r.content)
 
+# The parts of a page that an extractor needs. strainer is used with the BeautifulSoup
+# parsers and css (a CSS selector) with selectolax.
+ParseTarget = namedtuple('ParseTarget', ['strainer', 'css'])
 
+parser = DEFAULT_PARSER
 
-def get_page(url):
+def set_parser(name):
+    """Set the parser used by make_soup(): one of PARSERS."""
+    global parser
+    if name not in PARSERS:
+        raise ValueError(f'Unknown parser {name}; must be one of {", ".join(PARSERS)}')
+    if name != 'html.parser':
+        # fail now rather than on the first page
+        importlib.import_module(PARSER_MODULES.get(name, name))
+    parser = name
+
+def add_parser_argument(cmdline):
+    cmdline.add_argument('--parser', choices=PARSERS, default=DEFAULT_PARSER,
+                         help=f'HTML parser (default is {DEFAULT_PARSER}). lxml and selectolax are '
+                         'faster but must be installed separately')
+    return cmdline
+
+@metrics.timed('make_soup')
+def make_soup(markup, target=None):
+    """
+    Parse markup (HTML as bytes or str) with the selected parser. If target (a
+    ParseTarget) is given, only the parts of the page it specifies are built.
+    """
+    if parser != 'selectolax':
+        return BeautifulSoup(markup, parser, parse_only=target.strainer if target else None)
+
+    if target is None:
+        return BeautifulSoup(markup, 'html.parser')
+
+    # Let selectolax find the targets, then build the soup from just their HTML
+    from selectolax.lexbor import LexborHTMLParser
+    nodes = LexborHTMLParser(markup).css(target.css)
+    ids = {node.mem_id for node in nodes}
+
+    def nested(node):
+        parent = node.parent
+        while parent is not None:
+            if parent.mem_id in ids:
+                return True
+            parent = parent.parent
+        return False
+
+    return BeautifulSoup(''.join(node.html for node in nodes if not nested(node)),
+                         'html.parser')
+
+@metrics.timed('get_page')
+def get_page(url, target=None):
     def page_found(code):
         return code == 200
 
-    response = requests.get(url)
+    with host_limiter.limit(url):
+        response = http_client.get(url)
 
     if not page_found(response.status_code):
         print(f'Warning: status {response.status_code} for {url}')
         return None
     else:
-        return BeautifulSoup(response.content, 'html.parser')
+        return make_soup(response.content, target)
+
+
+@metrics.timed('get_page_incremental')
+def get_page_incremental(url, store, target=None):
+    """
+    Conditional version of get_page() using an incremental.PageStore. Return (soup, record).
+    If the page hasn't changed since it was last saved in store, soup is None and record is
+    the data saved for it. Otherwise record is None and soup is the page (or None if not
+    found) and the data scraped from it should be saved using store.save().
+    """
+    with host_limiter.limit(url):
+        response = http_client.get(url, headers=store.headers(url))
+
+    if response.status_code == 304:
+        return None, store.unchanged(url)
+
+    if response.status_code != 200:
+        print(f'Warning: status {response.status_code} for {url}')
+        return None, None
+
+    record = store.check(url, response)
+    if record is not None:
+        return None, record
 
+    return make_soup(response.content, target), None
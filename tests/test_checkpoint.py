@@ -0,0 +1,57 @@
+from checkpoint import open_journal, JOURNAL_SUFFIX
+from utils import OutputWriter, csv_to_dicts
+
+HEADER = ['Index', 'Title']
+
+
+def test_resume_truncates_rows_after_last_checkpoint(tmp_path):
+    output = str(tmp_path / 'out.csv')
+    journal = open_journal(output)
+    writer = OutputWriter(HEADER, output)
+    writer.as_csv([{'Index': 1, 'Title': 'a'}, {'Index': 2, 'Title': 'b'}])
+    journal.record('page', 'p1', writer.checkpoint(), next='p2')
+    # written but killed before the page was checkpointed
+    writer.as_csv([{'Index': 3, 'Title': 'c'}])
+    writer.checkpoint()
+    writer.close()
+    journal.close()
+    assert len(list(csv_to_dicts(output))) == 3
+
+    journal = open_journal(output, resume=True)
+    assert journal.is_done('page', 'p1')
+    assert journal.get('page', 'p1')['next'] == 'p2'
+    assert not journal.is_done('page', 'p2')
+    assert [row['Index'] for row in csv_to_dicts(output)] == ['1', '2']
+
+    with OutputWriter(HEADER, output) as writer:
+        writer.as_csv([{'Index': 3, 'Title': 'c'}])
+        journal.record('page', 'p2', writer.checkpoint())
+    journal.close()
+    assert [row['Index'] for row in csv_to_dicts(output)] == ['1', '2', '3']
+
+
+def test_incomplete_journal_line_is_ignored(tmp_path):
+    output = str(tmp_path / 'out.csv')
+    journal = open_journal(output)
+    with OutputWriter(HEADER, output) as writer:
+        writer.write({'Index': 1, 'Title': 'a'})
+        journal.record('page', 'p1', writer.checkpoint())
+    journal.close()
+    with open(output + JOURNAL_SUFFIX, 'a') as f:
+        f.write('{"kind": "page", "key": "p2", "off')
+
+    journal = open_journal(output, resume=True)
+    assert journal.is_done('page', 'p1')
+    assert not journal.is_done('page', 'p2')
+    journal.close()
+
+
+def test_without_resume_the_journal_starts_again(tmp_path):
+    output = str(tmp_path / 'out.csv')
+    journal = open_journal(output)
+    journal.record('page', 'p1', 0)
+    journal.close()
+
+    journal = open_journal(output)
+    assert not journal.is_done('page', 'p1')
+    journal.close()
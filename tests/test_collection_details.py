@@ -0,0 +1,52 @@
+import allcatsgrey_collection as collection
+from utils import OutputWriter, csv_to_dicts
+
+
+def write_manifest(filename, n):
+    with OutputWriter(collection.MANIFEST_HEADER, str(filename)) as writer:
+        for index in range(1, n + 1):
+            writer.write({'Index': index, 'Title': f'Record {index}',
+                          'URL': f'https://example.org/record/{index}',
+                          'Source': '', 'Call Number': f'C{index}'})
+
+
+def test_failed_detail_page_is_replaced_on_rerun(tmp_path, monkeypatch):
+    manifest = tmp_path / 'manifest.csv'
+    output = str(tmp_path / 'collection.csv')
+    write_manifest(manifest, 3)
+    failing = {2}
+
+    def fetch_page_data(url, index, store=None):
+        if index in failing:
+            return {'Index': index, 'Error': 'Timed out'}
+        return {'Index': index, 'Title': f'Record {index}', 'Description': 'Details'}
+
+    monkeypatch.setattr(collection, 'fetch_page_data', fetch_page_data)
+
+    summary = collection.get_details(output, str(manifest), workers=2)
+    assert summary == {'items': 3, 'errors': 1}
+
+    failing.clear()
+    summary = collection.get_details(output, str(manifest), workers=2)
+    assert summary == {'items': 1, 'errors': 0}
+
+    rows = list(csv_to_dicts(output))
+    assert sorted(row['Index'] for row in rows) == ['1', '2', '3']
+    assert not any(row['Error'] for row in rows)
+
+    # nothing left to fetch, and the file is unchanged
+    assert collection.get_details(output, str(manifest), workers=2) == {'items': 0, 'errors': 0}
+    assert len(list(csv_to_dicts(output))) == 3
+
+
+def test_detail_page_failing_again_keeps_one_row(tmp_path, monkeypatch):
+    manifest = tmp_path / 'manifest.csv'
+    output = str(tmp_path / 'collection.csv')
+    write_manifest(manifest, 2)
+    monkeypatch.setattr(collection, 'fetch_page_data',
+                        lambda url, index, store=None: {'Index': index, 'Error': 'Timed out'})
+
+    collection.get_details(output, str(manifest))
+    collection.get_details(output, str(manifest))
+
+    assert sorted(row['Index'] for row in csv_to_dicts(output)) == ['1', '2']
@@ -0,0 +1,72 @@
+import pytest
+import dedup
+import treeview_crawler
+from utils import OutputWriter, csv_to_dicts
+
+REPORT = 'https://allcatsrgrey.org.uk/wp/download/housing/report.pdf'
+
+
+def test_held_document_is_seen_in_the_same_run_only(tmp_path):
+    filename = str(tmp_path / 'seen.sqlite')
+    index = dedup.DedupIndex(filename)
+    entries = index.hold('archive', [REPORT], 'Report')
+    assert index.seen('category', [REPORT])
+
+    later = dedup.DedupIndex(filename)
+    assert not later.seen('category', [REPORT])
+
+    index.save(entries)
+    assert later.seen('category', [REPORT])
+    assert not index.held
+
+
+def test_urls_are_normalised(tmp_path):
+    index = dedup.DedupIndex(str(tmp_path / 'seen.sqlite'))
+    index.save(index.hold('archive', [REPORT]))
+    assert index.seen('downloads', ['http://www.allcatsrgrey.org.uk/WP/download/housing/report.pdf/'])
+
+
+def treeview(nodes):
+    return [{'id': f'wpfb-file-{i}', 'text': f'<a href="{url}">{title}</a>'}
+            for i, (url, title) in enumerate(nodes)]
+
+
+def crawler_for(tmp_path, writer, seen, monkeypatch):
+    crawler = treeview_crawler.TreeviewCrawler(writer, 'http://example.org/ajax', 1, seen)
+    monkeypatch.setattr(crawler, 'children', lambda root: treeview([(REPORT, 'Report')]))
+    return crawler
+
+
+def test_treeview_saves_fingerprints_after_rows(tmp_path, monkeypatch):
+    output = str(tmp_path / 'downloads.csv')
+    seen = dedup.DedupIndex(str(tmp_path / 'seen.sqlite'))
+    with OutputWriter(['Title', 'Categories', 'URL', 'Error'], output) as writer:
+        crawler_for(tmp_path, writer, seen, monkeypatch).scrape_folder('source')
+        # saved once the folder's rows were flushed, before the writer is closed
+        assert dedup.DedupIndex(str(tmp_path / 'seen.sqlite')).seen('downloads', [REPORT])
+    assert [row['URL'] for row in csv_to_dicts(output)] == [REPORT]
+
+
+def test_treeview_lost_rows_are_not_seen(tmp_path, monkeypatch):
+    class FailingWriter(OutputWriter):
+        def flush(self):
+            raise OSError('disk full')
+
+    seen = dedup.DedupIndex(str(tmp_path / 'seen.sqlite'))
+    writer = FailingWriter(['Title', 'Categories', 'URL', 'Error'], str(tmp_path / 'out.csv'))
+    with pytest.raises(OSError):
+        crawler_for(tmp_path, writer, seen, monkeypatch).scrape_folder('source')
+    assert not dedup.DedupIndex(str(tmp_path / 'seen.sqlite')).seen('downloads', [REPORT])
+
+
+def test_file_names_match_only_if_asked(tmp_path):
+    downloads = 'https://allcatsrgrey.org.uk/wp/download/report.pdf'
+    index = dedup.DedupIndex(str(tmp_path / 'seen.sqlite'))
+    index.save(index.hold('archive', [REPORT]))
+    assert not index.seen('downloads', [downloads])
+
+    index = dedup.DedupIndex(str(tmp_path / 'seen.sqlite'), match_filenames=True)
+    index.save(index.hold('archive', [REPORT]))
+    assert index.seen('downloads', [downloads])
+    # the same name on another host is another document
+    assert not index.seen('downloads', ['https://example.org/files/report.pdf'])
@@ -0,0 +1,36 @@
+import json
+import os
+import downloader
+
+
+def test_local_path_stays_in_folder():
+    assert (downloader.local_path('https://example.org/wp/../../%2e%2e/etc/./passwd', 'dl')
+            == os.path.join('dl', 'example.org', 'etc', 'passwd'))
+    assert (downloader.local_path('https://example.org/wp/', 'dl')
+            == os.path.join('dl', 'example.org', 'wp', 'index.html'))
+
+
+def test_etags_from_several_downloaders_are_kept(tmp_path):
+    folder = str(tmp_path)
+    # eg two shards downloading to the same folder
+    first = downloader.Downloader(folder)
+    second = downloader.Downloader(folder)
+    first.save_etag('https://example.org/a.pdf', '"a"')
+    second.save_etag('https://example.org/b.pdf', '"b"')
+    second.close()
+    first.close()
+
+    later = downloader.Downloader(folder)
+    assert later.etag('https://example.org/a.pdf') == '"a"'
+    assert later.etag('https://example.org/b.pdf') == '"b"'
+    later.close()
+
+
+def test_json_etags_are_imported(tmp_path):
+    with open(tmp_path / downloader.JSON_ETAG_FILENAME, 'w') as f:
+        json.dump({'https://example.org/a.pdf': '"a"'}, f)
+
+    d = downloader.Downloader(str(tmp_path))
+    assert d.etag('https://example.org/a.pdf') == '"a"'
+    assert not os.path.exists(tmp_path / downloader.JSON_ETAG_FILENAME)
+    d.close()
@@ -0,0 +1,58 @@
+import sqlite3
+import sys
+import link_records
+from utils import OutputWriter, csv_to_dicts
+
+COLLECTION_HEADER = ['Index', 'Title', 'Call Number', 'ISBN', 'Download']
+DOCUMENTS_HEADER = ['Title', 'Categories', 'URL', 'Error']
+
+
+def write_csv(filename, header, items):
+    with OutputWriter(header, str(filename)) as writer:
+        for item in items:
+            writer.write(item)
+
+
+def test_every_link_is_in_the_sqlite_table(tmp_path, monkeypatch):
+    write_csv(tmp_path / 'collection.csv', COLLECTION_HEADER, [
+        {'Index': '1', 'Title': 'Housing needs of older people'},
+        {'Index': '2', 'Title': 'Annual review'},
+    ])
+    # several documents with the same title as record 1, each an exact match
+    write_csv(tmp_path / 'documents.csv', DOCUMENTS_HEADER, [
+        {'Title': 'Housing needs of older people', 'URL': f'https://example.org/{i}.pdf'}
+        for i in range(3)
+    ] + [{'Title': 'Annual review', 'URL': 'https://example.org/review.pdf'}])
+
+    output = tmp_path / 'links.csv'
+    database = tmp_path / 'links.sqlite'
+    monkeypatch.setattr(sys, 'argv', [
+        'link_records.py', '--collection', str(tmp_path / 'collection.csv'),
+        '--documents', str(tmp_path / 'documents.csv'), '--csv', str(output),
+        '--top', '3', '--sqlite', str(database)])
+    link_records.main()
+
+    rows = list(csv_to_dicts(output))
+    assert len(rows) == 4
+    with sqlite3.connect(database) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM links').fetchone()[0] == len(rows)
+        assert conn.execute('SELECT COUNT(*) FROM links WHERE "index" = 1').fetchone()[0] == 3
+
+
+def test_rerun_replaces_links(tmp_path, monkeypatch):
+    write_csv(tmp_path / 'collection.csv', COLLECTION_HEADER,
+              [{'Index': '1', 'Title': 'Housing needs of older people'}])
+    write_csv(tmp_path / 'documents.csv', DOCUMENTS_HEADER, [
+        {'Title': 'Housing needs of older people', 'URL': f'https://example.org/{i}.pdf'}
+        for i in range(2)
+    ])
+    database = tmp_path / 'links.sqlite'
+    monkeypatch.setattr(sys, 'argv', [
+        'link_records.py', '--collection', str(tmp_path / 'collection.csv'),
+        '--documents', str(tmp_path / 'documents.csv'), '--csv', str(tmp_path / 'links.csv'),
+        '--top', '3', '--sqlite', str(database)])
+    link_records.main()
+    link_records.main()
+
+    with sqlite3.connect(database) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM links').fetchone()[0] == 2
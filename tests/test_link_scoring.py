@@ -0,0 +1,45 @@
+import link_records
+
+DOCUMENTS = [
+    {'Title': 'Housing needs of older people in Leeds', 'URL': 'https://example.org/wp/download/leeds-housing.pdf'},
+    {'Title': 'Annual review 2019', 'URL': 'https://example.org/wp/download/Financial-Sustainability.pdf'},
+    {'Title': 'Cervical screening standards data report', 'URL': 'https://example.org/wp/download/screening.pdf'},
+    {'Title': 'Guide to ISBN 978-1-86135-123-4 publications', 'URL': 'https://example.org/wp/download/guide.pdf'},
+] + [{'Title': f'Unrelated report number {i}', 'URL': f'https://example.org/wp/download/other-{i}.pdf'}
+     for i in range(200)]
+
+
+def index():
+    return link_records.DocumentIndex(DOCUMENTS, max_df=0.05)
+
+
+def test_exact_matches():
+    idx = index()
+    assert idx.match({'Title': 'Something else',
+                      'Download': '/downloads/example.org/financial-sustainability.pdf'}) \
+        == [(1, 1.0, link_records.FILENAME)]
+    assert idx.match({'Title': 'A guide', 'ISBN': '9781861351234'}) == [(3, 1.0, link_records.ISBN)]
+    assert idx.match({'Title': 'Housing Needs of Older People in Leeds.'}) \
+        == [(0, 1.0, link_records.TITLE)]
+
+
+def test_fuzzy_match_scores_similar_titles():
+    matches = index().match({'Title': 'Cervical screening standards: data report 2018'})
+    assert [(i, method) for i, score, method in matches] == [(2, link_records.FUZZY)]
+    assert link_records.DEFAULT_MIN_SCORE <= matches[0][1] < 1
+
+
+def test_no_match_below_min_score():
+    assert index().match({'Title': 'Transport strategy for rural areas'}) == []
+
+
+def test_top_limits_matches():
+    documents = [{'Title': 'Annual review', 'URL': f'https://example.org/{i}.pdf'} for i in range(5)]
+    idx = link_records.DocumentIndex(documents)
+    assert len(idx.match({'Title': 'Annual review'}, top=3)) == 3
+    assert len(idx.match({'Title': 'Annual review'})) == 1
+
+
+def test_isbns_and_filenames():
+    assert link_records.isbns('ISBN 978-1-86135-123-4 and 0 19 852663 X') == {'9781861351234', '019852663X'}
+    assert link_records.url_filename('https://example.org/a/Financial%20Report.PDF') == 'financial report'
@@ -0,0 +1,39 @@
+import time
+import incremental
+import metrics
+from utils import OutputWriter
+
+
+def test_delta_rows_are_counted_separately(tmp_path):
+    metrics.registry.reset()
+    header = ['Index', 'Title']
+    writer = incremental.IncrementalWriter(
+        OutputWriter(header, str(tmp_path / 'all.csv')),
+        OutputWriter(header, str(tmp_path / 'delta.csv'), counter=metrics.DELTA_ROWS))
+    with writer:
+        writer.write({'Index': 1, incremental.STATUS: incremental.NEW})
+        writer.write({'Index': 2, incremental.STATUS: incremental.UNCHANGED})
+
+    assert metrics.registry.counter(metrics.ROWS) == 2
+    assert metrics.registry.counter(metrics.DELTA_ROWS) == 1
+
+
+def test_generator_is_timed_while_it_runs():
+    metrics.registry.reset()
+
+    @metrics.timed('items')
+    def items():
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+
+    result = []
+    for item in items():
+        # the caller's time isn't counted
+        time.sleep(0.05)
+        result.append(item)
+
+    assert result == [0, 1, 2]
+    timer = metrics.registry.as_dict()['timers']['items']
+    assert timer['count'] == 1
+    assert 0.03 <= timer['total'] < 0.1
@@ -0,0 +1,57 @@
+import random
+import threading
+import time
+import pytest
+import pipeline
+
+
+def test_results_are_in_source_order():
+    def slow(item):
+        time.sleep(random.uniform(0, 0.005))
+        return item
+
+    stages = [pipeline.Stage('double', lambda item: item * 2, 4),
+              pipeline.Stage('slow', slow, 4)]
+    assert list(pipeline.run_pipeline(range(50), stages)) == [i * 2 for i in range(50)]
+
+
+def test_stage_error_is_raised_in_consumer():
+    def fail(item):
+        if item == 3:
+            raise ValueError('bad item')
+        return item
+
+    results = []
+    with pytest.raises(ValueError, match='bad item'):
+        for item in pipeline.run_pipeline(range(10), [pipeline.Stage('fail', fail, 2)]):
+            results.append(item)
+    assert results == [0, 1, 2]
+
+
+def test_source_error_is_raised_in_consumer():
+    def source():
+        yield 1
+        raise OSError('fetch failed')
+
+    with pytest.raises(OSError, match='fetch failed'):
+        list(pipeline.run_pipeline(source(), [pipeline.Stage('same', lambda item: item, 1)]))
+
+
+def test_slow_consumer_holds_back_source():
+    fed = []
+    lock = threading.Lock()
+
+    def source():
+        for i in range(100):
+            with lock:
+                fed.append(i)
+            yield i
+
+    results = pipeline.run_pipeline(source(), [pipeline.Stage('same', lambda item: item, 2)],
+                                    max_in_flight=4)
+    assert next(results) == 0
+    time.sleep(0.3)
+    with lock:
+        # at most max_in_flight items between source and consumer, plus one being put
+        assert len(fed) <= 6
+    results.close()
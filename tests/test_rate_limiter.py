@@ -0,0 +1,67 @@
+import pytest
+import rate_limiter
+
+URL = 'https://example.org/page'
+
+
+@pytest.fixture
+def controller():
+    return rate_limiter.RateController(rate=1, min_rate=0.1, max_rate=2, burst=1)
+
+
+def rate(controller):
+    return controller.hosts['example.org'].rate
+
+
+def test_rate_increases_while_responses_succeed(controller):
+    for _ in range(5):
+        controller.feedback(URL, 200, 0.1)
+    assert rate(controller) > 1
+    for _ in range(100):
+        controller.feedback(URL, 200, 0.1)
+    assert rate(controller) == 2
+
+
+def test_rate_halves_on_overload_at_most_once_per_holdoff(controller):
+    controller.feedback(URL, 503)
+    assert rate(controller) == pytest.approx(rate_limiter.DECREASE)
+    # more overloaded responses straight away don't decrease it again
+    controller.feedback(URL, 429)
+    controller.feedback(URL, error=True)
+    assert rate(controller) == pytest.approx(rate_limiter.DECREASE)
+    assert controller.hosts['example.org'].overloads == 3
+
+
+def test_slow_response_is_an_overload(controller):
+    controller.feedback(URL, 200, 0.1)
+    before = rate(controller)
+    controller.feedback(URL, 200, 0.1 * rate_limiter.SLOW_FACTOR * 2)
+    assert rate(controller) < before
+
+
+def test_retry_after_blocks_the_host(controller):
+    assert controller.reserve(URL) == 0
+    controller.feedback(URL, 429, retry_after='30')
+    assert controller.reserve(URL) == pytest.approx(30, abs=1)
+    # other hosts aren't blocked
+    assert controller.reserve('https://example.com/') == 0
+
+
+def test_requests_are_paced(controller):
+    assert controller.reserve(URL) == 0
+    # the bucket is empty, so the next request waits for a token at 1 request/sec
+    assert controller.reserve(URL) == pytest.approx(1, abs=0.05)
+
+
+def test_disabled_controller_does_not_wait(controller):
+    controller.enabled = False
+    controller.feedback(URL, 429, retry_after='30')
+    assert controller.reserve(URL) == 0
+    assert controller.reserve(URL) == 0
+
+
+def test_retry_after_values():
+    assert rate_limiter.retry_after_seconds('5') == 5
+    assert rate_limiter.retry_after_seconds('Thu, 01 Jan 1970 00:00:00 GMT') == 0
+    assert rate_limiter.retry_after_seconds('soon') is None
+    assert rate_limiter.retry_after_seconds(None) is None
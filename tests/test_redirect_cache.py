@@ -0,0 +1,52 @@
+import redirect_cache
+
+
+def test_expired_entries_are_misses(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(redirect_cache.time, 'time', lambda: now[0])
+    cache = redirect_cache.RedirectCache(str(tmp_path / 'cache.sqlite'), ttl_days=1)
+    cache.put('a', 'A')
+    assert cache.get('a') == 'A'
+
+    now[0] += redirect_cache.SECONDS_PER_DAY + 1
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(redirect_cache.time, 'time', lambda: now[0])
+    filename = str(tmp_path / 'cache.sqlite')
+    cache = redirect_cache.RedirectCache(filename, max_entries=2)
+    for url in 'abc':
+        now[0] += 1
+        cache.put(url, url.upper())
+    now[0] += 1
+    # a is used, so b is the least recently used
+    assert cache.get('a') == 'A'
+    cache.close()
+
+    cache = redirect_cache.RedirectCache(filename, max_entries=2)
+    assert [cache.get(url) for url in 'abc'] == ['A', None, 'C']
+    cache.close()
+
+
+def test_resolve_many_caches_only_successes(tmp_path):
+    calls = []
+
+    def resolver(url):
+        calls.append(url)
+        if url == 'bad':
+            raise ValueError(url)
+        return url.upper()
+
+    cache = redirect_cache.RedirectCache(str(tmp_path / 'cache.sqlite'))
+    result = cache.resolve_many(['a', 'bad', 'a', 'b'], resolver)
+    assert result['a'] == 'A' and result['b'] == 'B'
+    assert isinstance(result['bad'], ValueError)
+
+    calls.clear()
+    cache.resolve_many(['a', 'bad', 'b'], resolver)
+    assert calls == ['bad']
+    cache.close()
@@ -0,0 +1,65 @@
+import http.server
+import threading
+import pytest
+import requests
+import rate_limiter
+import redirect_cache
+import utils
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """/head-rejected/<n> rejects HEAD; /moved/<n> redirects to /docs/<n>; /gone/<n> is a 404."""
+
+    def do_HEAD(self):
+        if self.path.startswith('/head-rejected/'):
+            self.send_response(405)
+            self.end_headers()
+        else:
+            self.do_GET()
+
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        if self.path.startswith(('/moved/', '/head-rejected/')):
+            self.send_response(302)
+            self.send_header('Location', f'/docs/{name}')
+        elif self.path.startswith('/docs/'):
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site(monkeypatch):
+    # no need to be polite to the test server
+    monkeypatch.setattr(rate_limiter.controller, 'enabled', False)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_redirect_is_resolved(site):
+    assert utils.resolve_url(f'{site}/moved/a.pdf') == f'{site}/docs/a.pdf'
+
+
+def test_get_is_used_if_head_is_rejected(site):
+    assert utils.resolve_url(f'{site}/head-rejected/b.pdf') == f'{site}/docs/b.pdf'
+
+
+def test_error_is_raised_and_not_cached(site, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        utils.resolve_url(f'{site}/gone/c.pdf')
+
+    cache = redirect_cache.open_cache(str(tmp_path / 'redirects.sqlite'))
+    try:
+        resolved = utils.real_urls([f'{site}/gone/c.pdf', f'{site}/moved/d.pdf'])
+        assert isinstance(resolved[f'{site}/gone/c.pdf'], requests.HTTPError)
+        assert cache.get(f'{site}/gone/c.pdf') is None
+        assert cache.get(f'{site}/moved/d.pdf') == f'{site}/docs/d.pdf'
+    finally:
+        redirect_cache.close_cache()
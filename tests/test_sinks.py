@@ -0,0 +1,77 @@
+import sqlite3
+import pytest
+import sinks
+
+HEADER = ['Index', 'Title', 'URL']
+
+
+def rows(n, start=1):
+    return [[i, f'Title {i}', f'https://example.org/{i}.pdf'] for i in range(start, start + n)]
+
+
+def test_parquet_row_groups(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    filename = str(tmp_path / 'out.parquet')
+    sink = sinks.ParquetSink(HEADER, filename, row_group_size=10)
+    sink.write_rows(rows(3))
+    # one large batch is split into row groups of the given size
+    sink.write_rows(rows(32, 4))
+    sink.close()
+
+    metadata = pq.ParquetFile(filename).metadata
+    sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    assert sizes == [10, 10, 10, 5]
+    table = pq.read_table(filename)
+    assert table.column('index').to_pylist() == list(range(1, 36))
+
+
+def table_rows(filename, table):
+    with sqlite3.connect(filename) as conn:
+        return conn.execute(f'SELECT * FROM {table} ORDER BY rowid').fetchall()
+
+
+def test_sqlite_keyed_by_index(tmp_path):
+    filename = str(tmp_path / 'out.sqlite')
+    sink = sinks.SQLiteSink(HEADER, filename, 'collection')
+    sink.write_rows(rows(3))
+    sink.write_rows([[2, 'New title', 'https://example.org/2.pdf']])
+    sink.close()
+    assert sorted(table_rows(filename, 'collection'))[1] == (2, 'New title', 'https://example.org/2.pdf')
+    assert len(table_rows(filename, 'collection')) == 3
+
+
+def test_sqlite_keyed_by_url_without_index(tmp_path):
+    filename = str(tmp_path / 'out.sqlite')
+    sink = sinks.SQLiteSink(['Title', 'URL'], filename, 'archive')
+    sink.write_rows([['a', 'u1'], ['b', 'u2'], ['c', 'u1']])
+    sink.close()
+    assert sorted(table_rows(filename, 'archive')) == [('b', 'u2'), ('c', 'u1')]
+
+
+def test_sqlite_given_key(tmp_path):
+    filename = str(tmp_path / 'out.sqlite')
+    sink = sinks.SQLiteSink(HEADER, filename, 'links', ['Index', 'URL'])
+    sink.write_rows([[1, 'a', 'u1'], [1, 'a', 'u2'], [1, 'b', 'u2']])
+    sink.close()
+    assert sorted(table_rows(filename, 'links')) == [(1, 'a', 'u1'), (1, 'b', 'u2')]
+
+
+def test_sqlite_key_changed(tmp_path):
+    filename = str(tmp_path / 'out.sqlite')
+    with sqlite3.connect(filename) as conn:
+        # written before rows had a key
+        conn.execute('CREATE TABLE archive ("title" TEXT, "url" TEXT)')
+        conn.executemany('INSERT INTO archive VALUES (?, ?)', [('a', 'u1'), ('b', 'u1'), ('c', 'u2')])
+    sink = sinks.SQLiteSink(['Title', 'URL'], filename, 'archive')
+    sink.write_rows([['d', 'u2']])
+    sink.close()
+    assert sorted(table_rows(filename, 'archive')) == [('b', 'u1'), ('d', 'u2')]
+
+    # a table keyed by Index alone is re-keyed by Index and URL
+    sink = sinks.SQLiteSink(HEADER, filename, 'links')
+    sink.write_rows([[1, 'a', 'u1']])
+    sink.close()
+    sink = sinks.SQLiteSink(HEADER, filename, 'links', ['Index', 'URL'])
+    sink.write_rows([[1, 'a', 'u2']])
+    sink.close()
+    assert len(table_rows(filename, 'links')) == 2